@@ -1,30 +1,58 @@
-# Todo: add multithreading for faster compilation / spawning
-
 import re
 import os.path
 import subprocess
 import sys
 import copy
 import string
+import argparse
+import heapq
+import hashlib
+import json
+import pickle
+import io
+import shutil
+import select
+import struct
+import time
+import stat
+import traceback
+import shlex
 
 try:
   import threading as _threading
 except ImportError:
   import dummy_threading as _threading
-import xml.dom.minidom as dom
+import xml.etree.ElementTree as ET
+try:
+  import compile as _compile
+except ImportError:
+  _compile = None
+try:
+  import worker as _worker
+except ImportError:
+  _worker = None
 
 ###############################################################################
-# DOM helper
-
-def getDirectElementsByTagName(node, name):
-  return [e for e in node.childNodes 
-    if (e.nodeType == e.ELEMENT_NODE) and (e.tagName == name)]
+# XML helper
 
-def getFirstElementByTagName(node, name):
-  for e in node.childNodes:
-    if (e.nodeType == e.ELEMENT_NODE) and (e.tagName == name):
-      return e
-  return None
+# Incrementally parses file and yields (event, path, elem) for the start
+# and end of every element, path being the tags of its parents. After its
+# end an element is dropped from the tree unless one of its parents is in
+# keep, so only the subtrees the loaders actually use are held in memory.
+def StreamElements(file, keep=()):
+  path = []
+  stack = []
+  for event, elem in ET.iterparse(file, events=('start', 'end')):
+    if event == 'start':
+      yield event, path, elem
+      path.append(elem.tag)
+      stack.append(elem)
+      continue
+    path.pop()
+    stack.pop()
+    yield event, path, elem
+    if stack and not [tag for tag in path if tag in keep]:
+      stack[-1].remove(elem)
 
 
 ###############################################################################
@@ -52,18 +80,68 @@ def BatchListFull():
   b_FullRebuild = True
   return BatchList()
 
-def ResolveMacro(m):
-  s = m.group(1)
+# ctx holds the per file Input* macros of a job (see InputContext), so
+# several jobs can be resolved without sharing the module globals
+# UsedEnv collects the environment variables used by macros, a change to
+# them invalidates the build manifest
+UsedEnv = {}
+def ResolveMacro(m, ctx=None):
+  return ResolveName(m.group(1), ctx)
+
+def ResolveName(s, ctx=None):
+  if ctx and s in ctx: return ctx[s]
   try:
     if s == 'BatchList': return BatchList()
     if s == 'BatchListFull': return BatchListFull()
-    return eval(s)
+    return eval(s, globals(), ctx)
   except:
-    return os.environ[s]
+    UsedEnv[s] = os.environ[s]
+    return UsedEnv[s]
 
 resolverRe = re.compile('\$\((.*?)\)')
-def ResolveMacros(x):
-  return resolverRe.sub(ResolveMacro, x)
+def ResolveMacros(x, ctx=None):
+  return resolverRe.sub(lambda m: ResolveMacro(m, ctx), x)
+
+
+# A macro string compiled once for a configuration. The [Args] and all
+# $(Macros) not using one of the per file Input* variables or the per job
+# BatchList are resolved when compiling, so Render only has to fill in the
+# per file slots.
+# Render(ctx) gives the same result as resolving the [Args] and then
+# ResolveMacros(s, ctx).
+r_InputMacro = re.compile('\\bInput(Dir|Ext|Name|FileName|Path)\\b')
+s_InputsSlot = '\0Inputs\0' # placeholder for [Inputs], see Render
+
+class MacroTemplate:
+  def __init__(self, s, args=None):
+    if args and s.find('[') != -1:
+      s = r_argResolverRe.sub(lambda m: args.get(m.group(1), m.group(0)), s)
+    self.a_Parts = []  # literal strings and (macro,) slots
+    pos = 0
+    for m in resolverRe.finditer(s):
+      self.AddLiteral(s[pos:m.start()])
+      name = m.group(1)
+      if r_InputMacro.search(name) or name.startswith('BatchList'):
+        self.a_Parts.append((name,))
+      else: self.AddLiteral(ResolveName(name))
+      pos = m.end()
+    self.AddLiteral(s[pos:])
+    
+  def AddLiteral(self, s):
+    for i, lit in enumerate(s.split(s_InputsSlot)):
+      if i > 0: self.a_Parts.append((s_InputsSlot,))
+      if not lit: continue
+      if self.a_Parts and self.a_Parts[-1].__class__ is str:
+        self.a_Parts[-1] += lit
+      else: self.a_Parts.append(lit)
+      
+  def Render(self, ctx=None, inputs=""):
+    res = []
+    for part in self.a_Parts:
+      if part.__class__ is str: res.append(part)
+      elif part[0] == s_InputsSlot: res.append(inputs)
+      else: res.append(ResolveName(part[0], ctx))
+    return "".join(res)
 
 
 def AbsrelPath(path, relative):
@@ -74,14 +152,24 @@ def AbsrelPath(path, relative):
 def RelPath(path, relative):
   return os.path.relpath(path, relative)
 
+def InputContext(file, relative_path):
+  ctx = {}
+  ctx['InputPath'] = AbsrelPath( file, relative_path )
+  InputDir, ctx['InputFileName'] = os.path.split(ctx['InputPath'])
+  ctx['InputDir'] = InputDir + os.sep
+  ctx['InputName'], ctx['InputExt'] = os.path.splitext(ctx['InputFileName'])
+  return ctx
+
 def SetInput(file, relative_path):
   global InputPath, InputDir, InputFileName
   global InputName, InputExt
   
-  InputPath = AbsrelPath( file, relative_path )
-  InputDir, InputFileName = os.path.split(InputPath)  
-  InputDir += os.sep
-  InputName, InputExt = os.path.splitext(InputFileName)
+  ctx = InputContext(file, relative_path)
+  InputPath = ctx['InputPath']
+  InputDir = ctx['InputDir']
+  InputFileName = ctx['InputFileName']
+  InputName = ctx['InputName']
+  InputExt = ctx['InputExt']
     
     
 def PrintVars(): # Debug outputs variables
@@ -104,12 +192,133 @@ def PrintVars(): # Debug outputs variables
 ###############################################################################
 # Files support
 
-Files = []
-def AddFile(file):
-  global Files
-  file = os.path.normcase(os.path.realpath(file))
-  if file in Files: return
-  Files.append(file)
+def NormFile(file):
+  return os.path.normcase(os.path.realpath(file))
+
+def SafeName(name):
+  # a rule or tool name as part of a file name or argument, without spaces
+  # or separators
+  return re.sub(r'\W', '_', name)
+
+# All files of the project and the outputs generated from them, in the
+# order they were added. Files are indexed by their extension, so the files
+# of a rule are looked up instead of matched one by one.
+class FileRegistry:
+  def __init__(self):
+    self.h_Files = {}  # file -> [index, name of the producing rule]
+    self.h_ByExt = {}  # last .xyz of the file -> [file]
+    
+  def __contains__(self, file):
+    return file in self.h_Files
+    
+  def __iter__(self):
+    return iter(self.h_Files)
+    
+  def __len__(self):
+    return len(self.h_Files)
+    
+  def Add(self, file, producer=None):
+    if file in self.h_Files: return
+    self.h_Files[file] = [len(self.h_Files), producer]
+    ext = file[file.rfind('.'):] if '.' in file else ''
+    self.h_ByExt.setdefault(ext, []).append(file)
+    
+  def Producer(self, file):
+    # name of the rule generating file, None for project files
+    entry = self.h_Files.get(file)
+    return entry and entry[1]
+    
+  def Outputs(self):
+    return [file for file, entry in self.h_Files.items() if entry[1]]
+    
+  def Matching(self, rule):
+    exts = rule.Extensions()
+    if exts is None: 
+      return [file for file in self if rule.Match(file)]
+    files = []
+    for ext in exts:
+      files += self.h_ByExt.get(ext, [])
+    if len(exts) > 1:
+      files.sort(key=lambda file: self.h_Files[file][0])
+    return files
+
+Files = FileRegistry()
+def AddFile(file, producer=None):
+  file = NormFile(file)
+  Files.Add(file, producer)
+  return file
+
+###############################################################################
+# Stat cache
+
+# Holds the stat results of one build. The first lookup in a directory 
+# lists it with os.scandir, files that are not there never cost a stat
+# and every other file is only stat'd once. Outputs written by the build
+# are invalidated once their job finished.
+class StatCache:
+  def __init__(self):
+    self.h_Dirs  = {}     # directory -> set of names, None if missing
+    self.h_Stats = {}     # file -> (mtime_ns, size), None if missing
+    self.l_Lock  = _threading.Lock()
+    self.i_Lookups  = 0
+    self.i_Syscalls = 0   # stat and scandir calls done
+    
+  def Listing(self, dir):
+    with self.l_Lock:
+      if dir in self.h_Dirs: return self.h_Dirs[dir]
+    try:
+      with os.scandir(dir or os.curdir) as it:
+        names = set(os.path.normcase(e.name) for e in it)
+    except OSError:
+      names = None
+    with self.l_Lock:
+      self.i_Syscalls += 1
+      self.h_Dirs[dir] = names
+    return names
+    
+  def Stat(self, file):
+    # returns (mtime_ns, size) of file or None if it does not exist
+    file = os.path.normcase(file)
+    with self.l_Lock:
+      self.i_Lookups += 1
+      if file in self.h_Stats: return self.h_Stats[file]
+    dir, name = os.path.split(file)
+    names = self.Listing(dir)
+    st = None
+    if names is not None and name in names:
+      try:
+        st = os.stat(file)
+        st = (st.st_mtime_ns, st.st_size)
+      except OSError:
+        pass
+      with self.l_Lock:
+        self.i_Syscalls += 1
+    with self.l_Lock:
+      self.h_Stats[file] = st
+    return st
+    
+  def Invalidate(self, file):
+    file = os.path.normcase(file)
+    dir, name = os.path.split(file)
+    with self.l_Lock:
+      self.h_Stats.pop(file, None)
+      names = self.h_Dirs.get(dir)
+      if names is not None: names.add(name)
+      else: self.h_Dirs.pop(dir, None)
+      
+  def Forget(self, dir):
+    # drops the listing of dir and the files in it, after files were added
+    # or removed there
+    dir = os.path.normcase(dir)
+    with self.l_Lock:
+      self.h_Dirs.pop(dir, None)
+      for file in [f for f in self.h_Stats if os.path.dirname(f) == dir]:
+        del self.h_Stats[file]
+      
+  def Avoided(self):
+    return self.i_Lookups - self.i_Syscalls
+
+Stats = StatCache()
 
 ###############################################################################
 # Argument helpers  
@@ -130,6 +339,19 @@ def SplitArgs(s, seperators=" ;"):
   if len(arg) > 0: args.append(arg)
   return args
 
+# characters the shell would interpret, commands containing one of them
+# are run through the shell
+r_ShellSyntax = re.compile('[|&<>()%^\n]' if os.name == 'nt' else 
+  '[|&;<>()$`\'*?~#\\[\n\\\\]')
+
+def CommandArgs(cmd):
+  # splits a command line into its arguments like the shell would, returns
+  # None if it needs the shell
+  if r_ShellSyntax.search(cmd): return None
+  args = [arg.replace('"', '') for arg in SplitArgs(cmd, " \t")]
+  if not args or '=' in args[0]: return None # empty or sets a variable
+  return args
+
 def TermChars(s, terms):
   # could optimize this!
   o = ""
@@ -139,21 +361,979 @@ def TermChars(s, terms):
     o += c
   return o
   
+###############################################################################
+# In-process compile driver
+
+# Commands running the compile.py next to this file are run inside PyBuild
+# instead of starting an interpreter for every file.
+b_InProcess = True
+
+def CompileArgs(args, cwd):
+  # returns the arguments for compile.py if args only run it, else None
+  if not (_compile and args): return None
+  if os.path.basename(args[0]).lower().startswith('python'):
+    args = args[1:]
+  if not args or os.path.basename(args[0]).lower() != 'compile.py': return None
+  try:
+    if not os.path.samefile(os.path.join(cwd or os.curdir, args[0]), 
+      _compile.__file__): return None
+  except OSError:
+    return None
+  return args[1:]
+
+# returns (returncode, stdout, stderr) like Rule.RunCmd
+def RunInProcess(args, cwd, env=None):
+  out = io.StringIO()
+  err = io.StringIO()
+  try:
+    c = _compile.Compilation(args, cwd, env)
+    ret = c.Run(out, err)
+    if Trace:
+      for name, start, end in c.a_Spans:
+        Trace.Add(name, 'compile.py', start, end)
+  except Exception:
+    # an uncaught exception ends the interpreter with 1
+    err.write(str(sys.exc_info()[1]) + "\n")
+    ret = 1
+  enc = sys.stdout.encoding or 'utf-8'
+  return ret, out.getvalue().encode(enc, 'replace'), err.getvalue().encode(enc, 'replace')
+
+###############################################################################
+# Build tracing
+
+# With --trace the phases of a build and every command are recorded as
+# Chrome trace events (chrome://tracing or Perfetto can show the file),
+# and a summary of the slowest commands and the time spent is printed.
+class Tracer:
+  def __init__(self, file, slowest):
+    self.s_File = file
+    self.i_Slowest = slowest
+    self.a_Events = []
+    self.h_Threads = {}  # thread ident -> tid in the trace
+    self.l_Lock = _threading.Lock()
+    self.f_Start = time.perf_counter()
+    self.t_Times = os.times()
+    
+  def Add(self, name, cat, start, end, args=None):
+    # start and end are time.perf_counter() values
+    event = {'name': name, 'cat': cat, 'ph': 'X', 'pid': os.getpid(),
+      'ts': int((start - self.f_Start) * 1e6), 
+      'dur': int((end - start) * 1e6)}
+    if args: event['args'] = args
+    with self.l_Lock:
+      ident = _threading.get_ident()
+      if not ident in self.h_Threads:
+        self.h_Threads[ident] = len(self.h_Threads)
+      event['tid'] = self.h_Threads[ident]
+      self.a_Events.append(event)
+      
+  def Save(self):
+    with self.l_Lock:
+      events = list(self.a_Events)
+      for ident, tid in self.h_Threads.items():
+        events.append({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(),
+          'tid': tid, 'args': {'name': 'worker %d' % tid if tid else 'main'}})
+    tmp = self.s_File + '.tmp'
+    with open(tmp, 'w') as f:
+      json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+    os.replace(tmp, self.s_File)
+    
+  def Summary(self):
+    wall = time.perf_counter() - self.f_Start
+    t = os.times()
+    own = (t.user - self.t_Times.user) + (t.system - self.t_Times.system)
+    children = (t.children_user - self.t_Times.children_user) + (
+      t.children_system - self.t_Times.children_system)
+    with self.l_Lock:
+      cmds = [e for e in self.a_Events if e['cat'] == 'command']
+    cmds.sort(key=lambda e: -e['dur'])
+    if cmds and self.i_Slowest:
+      print( "------ Slowest commands ------" )
+      for e in cmds[:self.i_Slowest]:
+        print( "%8.3fs  %s" % (e['dur'] / 1e6, e['name']) )
+    print( "------ %.3fs wall, %.3fs cpu (%.3fs PyBuild, %.3fs commands), "
+      "%d commands ------" % (wall, own + children, own, children, len(cmds)) )
+    
+Trace = None
+
+# Records the time spent in a with block if tracing is on
+class Span:
+  def __init__(self, name, cat, args=None):
+    self.s_Name = name
+    self.s_Cat = cat
+    self.h_Args = args
+    
+  def __enter__(self):
+    self.f_Start = time.perf_counter()
+    return self
+    
+  def __exit__(self, *exc):
+    if Trace:
+      Trace.Add(self.s_Name, self.s_Cat, self.f_Start, time.perf_counter(),
+        self.h_Args)
+    
+###############################################################################
+# Job execution
+
+# A job is a single resolved command line. Its output is buffered and
+# written in one piece once the command finished, so the logs of parallel
+# jobs dont interleave.
+class Job:
+  def __init__(self, rule, cmd, desc=None, inputs=(), outputs=()):
+    self.r_Rule = rule
+    self.s_Cmd  = cmd
+    self.s_Desc = desc
+    self.a_Inputs  = list(inputs)
+    self.a_Outputs = list(outputs)
+    self.a_Deps  = []  # jobs producing one of a_Inputs
+    self.a_Parts = []  # per file jobs batched into this one
+    self.s_RspFile = None
+    self.s_RspContent = ""
+    self.i_Bucket = 0
+    self.o_Target = None  # target the job was planned for, see BuildGraph
+    self.o_Tool = None    # tool configuration that planned the job
+    self.i_Ret  = 0
+    self.b_Out  = b""
+    self.b_Err  = b""
+
+  # runs in a worker thread, so only the state saved in o_Target is used
+  def Run(self):
+    target = self.o_Target
+    if self.s_RspFile:
+      os.makedirs(os.path.dirname(self.s_RspFile), exist_ok=True)
+      with open(self.s_RspFile, 'w') as f:
+        f.write(self.s_RspContent)
+    span = Span(self.s_Desc or self.s_Cmd, 'command', {'cmd': self.s_Cmd})
+    with span:
+      if Cache and Cache.Restore(self):
+        self.i_Ret = 0
+        span.h_Args['cached'] = True
+      else:
+        start = time.perf_counter()
+        result = Workers and Workers.Run(self)
+        if result is None:
+          ret, out, err = self.r_Rule.RunCmdInPDir(
+            self.s_Cmd, target.s_ProjectDir, target.h_Env)
+          # keeps the note of a worker that failed the job
+          result = ret, out, self.b_Err + err
+        self.i_Ret, self.b_Out, self.b_Err = result
+        if self.i_Ret == 0:
+          target.o_Signatures.RecordDuration(self, time.perf_counter() - start)
+          if Cache: Cache.Store(self)
+      span.h_Args['ret'] = self.i_Ret
+    for file in self.a_Outputs:
+      Stats.Invalidate(file)
+    if self.i_Ret == 0:
+      # a chunk of a batch records the signatures of its files
+      for job in (self.a_Parts or [self]):
+        target.o_Signatures.Record(job)
+    return self.i_Ret
+    
+  def Key(self):
+    return os.pathsep.join(self.a_Outputs)
+
+  def Report(self):
+    if self.s_Desc: print( self.s_Desc )
+    sys.stdout.flush()
+    sys.stdout.buffer.write(self.b_Out)
+    sys.stdout.flush()
+    sys.stderr.buffer.write(self.b_Err)
+    sys.stderr.flush()
+    if self.i_Ret != 0:
+      print( self.s_Cmd , file=sys.stderr )
+      print("Returned with error", self.i_Ret)
+
+# Stands for the jobs of a bucket with outputs no job takes as input, the
+# jobs of later buckets are ordered after it instead of after each of them
+# (see BuildGraph.Finish). It has no command.
+class Barrier(Job):
+  def __init__(self, target, bucket, deps):
+    Job.__init__(self, None, None)
+    self.i_Bucket = bucket
+    self.o_Target = target
+    self.a_Deps = deps
+    self.a_After = []
+    
+  def Run(self):
+    return 0
+    
+  def Report(self):
+    pass
+
+
+# The jobs of all execution buckets of a build. A job depends on the jobs
+# producing its inputs, so buckets overlap as far as their files allow.
+# Outputs no rule takes as input, like the headers of a moc or uic style
+# generator, may still be included by a later bucket, so the jobs of later
+# buckets are ordered after the jobs producing them (see Finish).
+# Jobs are added in bucket order, so edges always point to earlier jobs.
+# a_Schedule holds the jobs to run, with the Barriers of Finish in between.
+class BuildGraph:
+  def __init__(self):
+    self.a_Jobs = []
+    self.h_Producer = {}
+    self.o_Target = None  # target of the jobs added next
+    self.o_Tool = None    # tool configuration of the jobs added next
+    self.b_All = False    # plan the up to date jobs as well (--emit-ninja)
+    
+  def Producer(self, file):
+    return self.h_Producer.get(file)
+    
+  def Add(self, job, bucket):
+    job.i_Bucket = bucket
+    job.i_Seq = len(self.a_Jobs)
+    job.o_Target = self.o_Target
+    job.o_Tool = self.o_Tool
+    deps = set()
+    for file in job.a_Inputs:
+      dep = self.h_Producer.get(file)
+      if dep and (dep is not job) and not (dep in deps):
+        deps.add(dep)
+        job.a_Deps.append(dep)
+    for file in job.a_Outputs:
+      self.h_Producer[file] = job
+    self.a_Jobs.append(job)
+    
+  def Finish(self):
+    # adds the order only edges once all jobs are known. The jobs of a
+    # (target, bucket) with outputs no job consumes get a Barrier once the
+    # next bucket of the target starts, which depends on them and on the
+    # Barrier before it. A job then only depends on the last Barrier of
+    # its target.
+    consumed = set()
+    for job in self.a_Jobs:
+      consumed.update(job.a_Inputs)
+    loose = {}  # target -> [bucket, jobs] of the bucket added last
+    last = {}   # target -> Barrier of the buckets before
+    self.a_Schedule = []
+    for job in self.a_Jobs:
+      target = job.o_Target
+      group = loose.get(target)
+      if group and group[0] < job.i_Bucket:
+        barrier = Barrier(target, group[0], 
+          group[1] + ([last[target]] if target in last else []))
+        self.a_Schedule.append(barrier)
+        last[target] = barrier
+        del loose[target]
+      job.a_After = [last[target]] if target in last else []
+      job.a_Deps += job.a_After
+      self.a_Schedule.append(job)
+      if [file for file in job.a_Outputs if not file in consumed]:
+        loose.setdefault(target, [job.i_Bucket, []])[1].append(job)
+    for i, job in enumerate(self.a_Schedule):
+      job.i_Seq = i
+
+
+###############################################################################
+# GNU make jobserver
+
+# Limits the commands running at once across the whole process tree like
+# GNU make does: besides the one slot every process has for free, each
+# running command needs a token read from a pipe shared with the child
+# processes and writes it back when it finished. Started by make PyBuild
+# takes its tokens from the jobserver of make, otherwise it serves one to
+# the make (or other jobserver aware tool) its rules start.
+r_JobserverAuth = re.compile('--jobserver-(?:auth|fds)=(?:fifo:(\\S+)|(\\d+),(\\d+))')
+
+class JobServer:
+  def __init__(self, read, write, fds):
+    self.i_Read = read
+    self.i_Write = write
+    self.a_Fds = fds     # passed to the child processes
+    self.b_Free = True   # the free slot is not used
+    self.l_Lock = _threading.Lock()
+    
+  def Acquire(self):
+    # blocks until a command may run, returns the token taken or None for
+    # the free slot
+    with self.l_Lock:
+      if self.b_Free:
+        self.b_Free = False
+        return None
+    while True:
+      try:
+        return os.read(self.i_Read, 1) # empty if the jobserver is gone
+      except BlockingIOError:
+        # a child made the shared pipe non blocking
+        select.select([self.i_Read], [], [])
+        
+  def Release(self, token):
+    if token is None:
+      with self.l_Lock: self.b_Free = True
+    elif token:
+      os.write(self.i_Write, token)
+      
+Jobserver = None
+
+def IsPipe(fd):
+  try:
+    return stat.S_ISFIFO(os.fstat(fd).st_mode)
+  except OSError:
+    return False
+
+def StartJobServer(jobs):
+  # joins the jobserver of the make running PyBuild or serves one for jobs
+  # commands at once
+  if os.name == 'nt': return None
+  flags = os.environ.get('MAKEFLAGS', '')
+  m = r_JobserverAuth.search(flags)
+  if m and m.group(1):
+    try:
+      fd = os.open(m.group(1), os.O_RDWR)
+      return JobServer(fd, fd, ())
+    except OSError:
+      pass
+  elif m:
+    # make closes the pipe for commands it does not consider recursive
+    r, w = int(m.group(2)), int(m.group(3))
+    if IsPipe(r) and IsPipe(w): return JobServer(r, w, (r, w))
+    
+  r, w = os.pipe()
+  os.write(w, b'+' * (jobs - 1))
+  flags = [f for f in flags.split() 
+    if not (f.startswith('--jobserver') or re.match('-j\\d*$', f))]
+  os.environ['MAKEFLAGS'] = ' '.join(flags + ['-j%d' % jobs, 
+    '--jobserver-auth=%d,%d' % (r, w)])
+  return JobServer(r, w, (r, w))
+  
+###############################################################################
+# Job scheduling
+
+# Runs jobs on at most i_Jobs worker threads. A job is started once all
+# jobs it depends on finished. Of the ready jobs the one with the longest
+# expected chain of jobs left behind it is started first, so long jobs on
+# the critical path dont end up stretching the build. Jobs are held back
+# while the machine has no room for them, see Fits. After the first
+# failing job no further jobs are started, the running ones are waited for.
+class JobPool:
+  def __init__(self, jobs, maxload=0, minfree=None):
+    self.i_Jobs = max(1, jobs)
+    self.f_MaxLoad = maxload  # no new jobs above this load average
+    self.i_MinFree = minfree  # MB of memory left free, None for 5%
+    self.c_Cond = _threading.Condition()
+    self.a_Running = []
+    
+  def Fits(self, job, load, mem):
+    # tells if job may start now. One job can always run, more only if
+    # their tool allows, the load average is below f_MaxLoad and the
+    # available memory covers the MemoryUsage of the job besides the jobs
+    # started lately, which may not have allocated theirs yet. load and
+    # mem are the LoadAverage and MemoryInfo sampled by Next.
+    if not self.a_Running: return True
+    tool = job.o_Tool
+    if tool and tool.i_MaxParallel:
+      same = [j for j in self.a_Running if j.r_Rule is job.r_Rule]
+      if len(same) >= tool.i_MaxParallel: return False
+    if self.f_MaxLoad and load is not None and load >= self.f_MaxLoad:
+      return False
+    if mem:
+      total, avail = mem
+      now = time.monotonic()
+      need = self.i_MinFree if self.i_MinFree is not None else total // 20
+      for j in self.a_Running + [job]:
+        if j is job or now - j.f_Started < 10:
+          need += j.o_Tool.i_MemoryUsage if j.o_Tool else 0
+      if avail < need: return False
+    return True
+    
+  def Next(self):
+    # pops the first ready job that fits or returns None. The load and
+    # memory are sampled once for all the jobs checked.
+    if not self.a_Ready: return None
+    load = mem = None
+    if self.a_Running:
+      load = LoadAverage() if self.f_MaxLoad else None
+      mem = MemoryInfo()
+    if self.Fits(self.a_Ready[0][-1], load, mem):
+      return heapq.heappop(self.a_Ready)[-1]
+    for entry in sorted(self.a_Ready)[1:]:
+      if self.Fits(entry[-1], load, mem):
+        self.a_Ready.remove(entry)
+        heapq.heapify(self.a_Ready)
+        return entry[-1]
+    return None
+    
+  def Worker(self):
+    while True:
+      with self.c_Cond:
+        while True:
+          if self.i_Error or not self.i_Left: return
+          job = self.Next()
+          if job: break
+          # held back jobs are checked again after a while
+          self.c_Cond.wait(0.5 if self.a_Ready else None)
+        job.f_Started = time.monotonic()
+        self.a_Running.append(job)
+      # a Barrier runs no command, so it needs no token
+      token = Jobserver.Acquire() if Jobserver and \
+        not isinstance(job, Barrier) else None
+      try:
+        ret = job.Run()
+      except Exception:
+        # a bug or an unexpected file fails the job like a failing command
+        job.b_Err += traceback.format_exc().encode()
+        job.i_Ret = ret = 1
+      finally:
+        if Jobserver: Jobserver.Release(token)
+      with self.c_Cond:
+        try:
+          job.Report()
+        except Exception:
+          # e.g. the pipe to a pager was closed, the build has to stop
+          if ret == 0: ret = 1
+        finally:
+          self.a_Running.remove(job)
+          self.i_Left -= 1
+          if ret != 0:
+            if not self.i_Error: self.i_Error = ret
+          else:
+            for user in job.a_Users:
+              user.i_Waiting -= 1
+              if user.i_Waiting == 0: self.Push(user)
+          self.c_Cond.notify_all()
+        
+  def Push(self, job):
+    heapq.heappush(self.a_Ready, 
+      (-job.f_Critical, job.i_Bucket, job.i_Seq, job))
+    
+  def Run(self, jobs):
+    # returns 0 or the error code of the first failed job
+    jobs = list(jobs)
+    self.a_Ready = []
+    self.i_Left = len(jobs)
+    self.i_Error = 0
+    for i, job in enumerate(jobs):
+      if not hasattr(job, 'i_Seq'): job.i_Seq = i
+      job.a_Users = []
+      job.i_Waiting = len(job.a_Deps)
+    for job in jobs:
+      for dep in job.a_Deps: dep.a_Users.append(job)
+    # the users of a job come after it, see BuildGraph
+    estimates = Estimates(jobs)
+    for job in reversed(jobs):
+      job.f_Critical = estimates[job] + max(
+        [user.f_Critical for user in job.a_Users] or [0])
+    for job in jobs:
+      if job.i_Waiting == 0: self.Push(job)
+    workers = []
+    for i in range(min(self.i_Jobs, len(jobs))):
+      t = _threading.Thread(target=self.Worker)
+      t.start()
+      workers.append(t)
+    for t in workers:
+      t.join()
+    return self.i_Error
+
+Pool = JobPool(1)
+
+def LoadAverage():
+  # the load average of the last minute or None if it is not known
+  try:
+    return os.getloadavg()[0]
+  except (AttributeError, OSError):
+    return None
+
+def MemoryInfo():
+  # returns (total, available) memory in MB or None if it is not known
+  try:
+    with open('/proc/meminfo') as f:
+      info = dict(line.split(':', 1) for line in f)
+    return (int(info['MemTotal'].split()[0]) >> 10, 
+      int(info['MemAvailable'].split()[0]) >> 10)
+  except (OSError, ValueError, KeyError):
+    return None
+
+def Estimates(jobs):
+  # returns the expected run time of every job, which is the time it took
+  # last. Jobs without history are expected to take the time per input byte
+  # of the jobs with history.
+  known = {}
+  sizes = {}
+  for job in jobs:
+    sigs = job.o_Target.o_Signatures if job.o_Target else Signatures
+    sizes[job] = 0
+    for file in job.a_Inputs:
+      st = Stats.Stat(file)
+      if st: sizes[job] += st[1]
+    duration = sigs and sigs.Duration(job)
+    if duration is not None: known[job] = duration
+  size = sum(sizes[job] for job in known)
+  rate = sum(known.values()) / size if size else 1e-6
+  return dict((job, known.get(job, sizes[job] * rate)) for job in jobs)
+
+###############################################################################
+# Signature database
+
+# Remembers for each job the hashes of its inputs, outputs and command line
+# as of its last successful run. A job only has to run again if one of
+# them changed, touching a file just costs hashing it. File hashes are
+# cached by mtime and size, so unchanged files are not even read.
+class SignatureDb:
+  def __init__(self, file, depdir):
+    self.s_File  = file
+    self.s_DepDir = depdir  # recorded headers of compile.py
+    self.h_Stamps = {}  # file -> [mtime_ns, size, hash]
+    self.h_Jobs   = {}  # job key -> signature
+    self.h_Times  = {}  # output -> seconds its job took last
+    self.l_Lock = _threading.Lock()
+    try:
+      with open(file) as f:
+        data = json.load(f)
+      self.h_Stamps = data['stamps']
+      self.h_Jobs   = data['jobs']
+      self.h_Times  = data.get('times', {})
+    except (OSError, ValueError, KeyError):
+      pass
+      
+  def Save(self):
+    with self.l_Lock:
+      data = {'stamps': self.h_Stamps, 'jobs': self.h_Jobs, 
+        'times': self.h_Times}
+    tmp = self.s_File + '.tmp'
+    os.makedirs(os.path.dirname(tmp), exist_ok=True)
+    with open(tmp, 'w') as f:
+      json.dump(data, f)
+    os.replace(tmp, self.s_File)
+    
+  def Hash(self, file):
+    # returns the content hash of file, None if it does not exist and False
+    # if it cant be read, like a directory
+    st = Stats.Stat(file)
+    if st is None:
+      return None
+    with self.l_Lock:
+      stamp = self.h_Stamps.get(file)
+    if stamp and stamp[0] == st[0] and stamp[1] == st[1]:
+      return stamp[2]
+    h = hashlib.sha1()
+    try:
+      with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), b""):
+          h.update(block)
+    except OSError:
+      return False
+    digest = h.hexdigest()
+    with self.l_Lock:
+      self.h_Stamps[file] = [st[0], st[1], digest]
+    return digest
+    
+  def Signature(self, job):
+    # returns None if a file of job cant be hashed, its file times decide
+    # if it is outdated then
+    inputs = {}
+    for file in job.a_Inputs + RecordedDeps(job.a_Outputs, self.s_DepDir):
+      inputs[file] = self.Hash(file)
+      if inputs[file] is False: return None
+    outputs = {}
+    for file in job.a_Outputs:
+      outputs[file] = self.Hash(file)
+      if outputs[file] is False: return None
+    cmd = hashlib.sha1(job.s_Cmd.encode()).hexdigest()
+    return {'cmd': cmd, 'inputs': inputs, 'outputs': outputs}
+    
+  def UpToDate(self, job):
+    # returns None if job never ran with a signature recorded
+    with self.l_Lock:
+      sig = self.h_Jobs.get(job.Key())
+    if sig is None: return None
+    if sig['cmd'] != hashlib.sha1(job.s_Cmd.encode()).hexdigest():
+      return False
+    for file in job.a_Inputs:
+      if not file in sig['inputs']: return False
+    for file, digest in sig['inputs'].items():
+      if self.Hash(file) != digest: return False
+    for file, digest in sig['outputs'].items():
+      if digest is None or self.Hash(file) != digest: return False
+    return True
+    
+  def Record(self, job):
+    sig = self.Signature(job)
+    with self.l_Lock:
+      if sig is None: self.h_Jobs.pop(job.Key(), None)
+      else: self.h_Jobs[job.Key()] = sig
+      
+  def RecordDuration(self, job, seconds):
+    # a chunk of a batch splits its time evenly between its files
+    parts = job.a_Parts or [job]
+    with self.l_Lock:
+      for part in parts:
+        for out in part.a_Outputs:
+          self.h_Times[out] = seconds / len(parts)
+          
+  def Duration(self, job):
+    # returns the seconds job took last or None if that is not known
+    total = 0
+    with self.l_Lock:
+      for part in (job.a_Parts or [job]):
+        times = [self.h_Times[out] for out in part.a_Outputs 
+          if out in self.h_Times]
+        if not times: return None
+        total += max(times)
+    return total
+
+Signatures = None
+
+def DepRecordFile(out, depdir):
+  # the file compile.py records the headers of out in (see PYBUILD_DEPDB),
+  # keyed by the path normalized like the Files are on both sides
+  key = hashlib.sha1(NormFile(out).encode()).hexdigest()
+  return os.path.join(depdir, key + '.json')
+
+def RecordedDeps(outputs, depdir):
+  # headers compile.py found for the given outputs
+  deps = []
+  for out in outputs:
+    try:
+      with open(DepRecordFile(out, depdir)) as f:
+        deps += [d for d in json.load(f)['deps'] if not d in deps]
+    except (OSError, ValueError, KeyError):
+      pass
+  return deps
+
+###############################################################################
+# Artifact cache
+
+# Stores the outputs of successful jobs in a directory shared by all
+# checkouts. A job whose key is found gets its outputs linked or copied
+# from the cache instead of running. The key is found in two steps like
+# ccache does: the manifest of the command line and the input contents
+# names the headers recorded for them, the contents of those headers
+# complete the key of the outputs. Paths in ProjectDir are stored relative
+# to it, so checkouts in other directories share the entries.
+class ArtifactCache:
+  def __init__(self, dir, size):
+    self.s_Dir = dir
+    self.i_MaxSize = size
+    self.i_Hits = 0
+    self.i_Misses = 0
+    self.i_Evicted = 0
+    self.l_Lock = _threading.Lock()
+    
+  def Portable(self, s, target):
+    return s.replace(target.s_ProjectDir, '$(ProjectDir)')
+    
+  def Local(self, s, target):
+    return s.replace('$(ProjectDir)', target.s_ProjectDir)
+    
+  def Manifest(self, job):
+    # returns the manifest key of job or None if an input is missing
+    t = job.o_Target
+    h = hashlib.sha1()
+    h.update(self.Portable(job.s_Cmd, t).encode() + b'\0')
+    h.update(self.Portable(job.s_RspContent, t).encode() + b'\0')
+    for file in job.a_Inputs:
+      digest = t.o_Signatures.Hash(file)
+      if not digest: return None
+      h.update((self.Portable(file, t) + '\0' + digest + '\0').encode())
+    return h.hexdigest()
+    
+  def ManifestFile(self, manifest):
+    return os.path.join(self.s_Dir, 'manifests', manifest[:2], manifest + '.json')
+    
+  def Key(self, manifest, deps, target):
+    # returns the output key for the portable paths deps or None if one of
+    # them is missing
+    h = hashlib.sha1(manifest.encode())
+    for dep in deps:
+      digest = target.o_Signatures.Hash(self.Local(dep, target))
+      if not digest: return None
+      h.update((dep + '\0' + digest + '\0').encode())
+    return h.hexdigest()
+    
+  def EntryDir(self, key):
+    return os.path.join(self.s_Dir, 'objects', key[:2], key)
+    
+  def NeedsDeps(self, job):
+    # compile.py jobs depend on the headers it records, without a record
+    # their key would miss them
+    return CompileArgs(CommandArgs(job.s_Cmd), job.o_Target.s_ProjectDir) \
+      is not None
+    
+  def Lookup(self, job):
+    # returns the entry directory of job or None
+    if not job.a_Outputs: return None
+    job.s_CacheManifest = self.Manifest(job)
+    if job.s_CacheManifest is None: return None
+    try:
+      with open(self.ManifestFile(job.s_CacheManifest)) as f:
+        deps = json.load(f)['deps']
+    except (OSError, ValueError, KeyError):
+      return None
+    if not deps and self.NeedsDeps(job): return None
+    key = self.Key(job.s_CacheManifest, deps, job.o_Target)
+    if key is None: return None
+    entry = self.EntryDir(key)
+    if not os.path.exists(os.path.join(entry, 'entry.json')): return None
+    return entry
+    
+  def Restore(self, job):
+    # restores the outputs of job and returns True on a hit
+    t = job.o_Target
+    entry = self.Lookup(job)
+    if entry:
+      try:
+        with open(os.path.join(entry, 'entry.json')) as f:
+          data = json.load(f)
+        for i, out in enumerate(job.a_Outputs):
+          if data['outputs'][i] != self.Portable(out, t): raise KeyError(out)
+        for i, out in enumerate(job.a_Outputs):
+          LinkOrCopy(os.path.join(entry, str(i)), out)
+        for out, rec in data['deps'].items():
+          rec = MapStrings(rec, lambda s: self.Local(s, t))
+          WriteJson(DepRecordFile(self.Local(out, t), t.s_DepDir), rec)
+        with open(os.path.join(entry, 'out'), 'rb') as f: job.b_Out = f.read()
+        with open(os.path.join(entry, 'err'), 'rb') as f: job.b_Err = f.read()
+        # the entry was used last now
+        os.utime(os.path.join(entry, 'entry.json'))
+        with self.l_Lock: self.i_Hits += 1
+        return True
+      except (OSError, ValueError, KeyError, IndexError):
+        pass
+    with self.l_Lock: self.i_Misses += 1
+    # outputs linked from the cache are unlinked, so a tool writing them in
+    # place cannot change the cached copy
+    for out in job.a_Outputs:
+      try:
+        if os.stat(out).st_nlink > 1: os.unlink(out)
+      except OSError:
+        pass
+    return False
+    
+  def Store(self, job):
+    t = job.o_Target
+    manifest = getattr(job, 's_CacheManifest', None)
+    if not manifest: return
+    for out in job.a_Outputs:
+      if not os.path.isfile(out): return
+    deps = [self.Portable(dep, t) for dep in RecordedDeps(job.a_Outputs, t.s_DepDir)]
+    if not deps and self.NeedsDeps(job): return
+    key = self.Key(manifest, deps, t)
+    if key is None: return
+    entry = self.EntryDir(key)
+    try:
+      WriteJson(self.ManifestFile(manifest), {'deps': deps})
+      if os.path.exists(entry): return
+      tmp = entry + '.%d.%d.tmp' % (os.getpid(), _threading.get_ident())
+      os.makedirs(tmp)
+      for i, out in enumerate(job.a_Outputs):
+        shutil.copy(out, os.path.join(tmp, str(i)))
+      recs = {}
+      for out in job.a_Outputs:
+        try:
+          with open(DepRecordFile(out, t.s_DepDir)) as f:
+            recs[self.Portable(out, t)] = MapStrings(json.load(f), 
+              lambda s: self.Portable(s, t))
+        except (OSError, ValueError):
+          pass
+      with open(os.path.join(tmp, 'out'), 'wb') as f: f.write(job.b_Out)
+      with open(os.path.join(tmp, 'err'), 'wb') as f: f.write(job.b_Err)
+      WriteJson(os.path.join(tmp, 'entry.json'), {'outputs': 
+        [self.Portable(out, t) for out in job.a_Outputs], 'deps': recs})
+      try:
+        os.rename(tmp, entry)
+      except OSError:
+        shutil.rmtree(tmp, True) # stored by another build meanwhile
+    except OSError:
+      pass
+      
+  def Trim(self):
+    # evicts the least recently used entries until the cache fits i_MaxSize
+    entries = []
+    total = 0
+    objects = os.path.join(self.s_Dir, 'objects')
+    for d in os.listdir(objects) if os.path.isdir(objects) else []:
+      for key in os.listdir(os.path.join(objects, d)):
+        entry = os.path.join(objects, d, key)
+        try:
+          used = os.stat(os.path.join(entry, 'entry.json')).st_mtime
+          size = sum(e.stat().st_size for e in os.scandir(entry))
+        except OSError:
+          continue
+        entries.append((used, size, entry))
+        total += size
+    entries.sort()
+    for used, size, entry in entries:
+      if total <= self.i_MaxSize: break
+      shutil.rmtree(entry, True)
+      total -= size
+      self.i_Evicted += 1
+      
+Cache = None
+
+def WriteJson(file, data):
+  os.makedirs(os.path.dirname(file), exist_ok=True)
+  tmp = file + '.%d.%d.tmp' % (os.getpid(), _threading.get_ident())
+  with open(tmp, 'w') as f:
+    json.dump(data, f)
+  os.replace(tmp, file)
+  
+def WriteIfChanged(file, content):
+  # keeps the file time of files that would not change
+  try:
+    with open(file) as f:
+      if f.read() == content: return
+  except OSError:
+    pass
+  os.makedirs(os.path.dirname(file), exist_ok=True)
+  with open(file + '.tmp', 'w') as f:
+    f.write(content)
+  os.replace(file + '.tmp', file)
+
+def MapStrings(data, func):
+  # applies func to all strings in the json data
+  if isinstance(data, str): return func(data)
+  if isinstance(data, list): return [MapStrings(x, func) for x in data]
+  if isinstance(data, dict): 
+    return dict((k, MapStrings(v, func)) for k, v in data.items())
+  return data
+  
+def LinkOrCopy(src, dst):
+  # links src to dst, copies it if it cannot be linked
+  if os.path.lexists(dst): os.unlink(dst)
+  os.makedirs(os.path.dirname(dst), exist_ok=True)
+  try:
+    os.link(src, dst)
+  except OSError:
+    shutil.copy(src, dst)
+  os.utime(dst)
+
+###############################################################################
+# Build workers
+
+# With --workers the compile.py jobs are shipped to worker.py daemons. A job
+# goes to the worker running the fewest of our jobs, with its source and the
+# headers compile.py recorded for it, or found by running the preprocessor
+# here if there are none yet. Headers outside the ProjectDir are expected
+# at the same path on the worker, like the compiler itself. Jobs that cant
+# be shipped run locally, as do the jobs of a worker that cant be reached
+# or sent nothing, not even a heartbeat, for i_Timeout seconds. Such a
+# worker is tried again after i_RetryDelay seconds.
+class WorkerPool:
+  i_RetryDelay = 30
+  i_Timeout = 6 * (_worker.i_Heartbeat if _worker else 10)
+  
+  def __init__(self, addresses, token=''):
+    self.a_Addresses = addresses
+    self.s_Token = token  # secret the workers expect, see worker.py
+    self.h_Running = dict((address, 0) for address in addresses)
+    self.h_Down = {}  # address -> time it could not be reached
+    self.i_Remote = 0
+    self.i_Local = 0
+    self.l_Lock = _threading.Lock()
+    
+  def Pick(self):
+    # returns the reachable worker with the fewest jobs running or None
+    with self.l_Lock:
+      now = time.monotonic()
+      up = [address for address in self.a_Addresses 
+        if now - self.h_Down.get(address, -self.i_RetryDelay) >= self.i_RetryDelay]
+      if not up: return None
+      address = min(up, key=lambda address: self.h_Running[address])
+      self.h_Running[address] += 1
+      return address
+    
+  def Relative(self, file, pdir):
+    file = os.path.normpath(os.path.join(pdir, file))
+    if not file.startswith(pdir): return None
+    return file[len(pdir):]
+    
+  def Files(self, job, deps):
+    # returns the contents of the inputs and deps of job by their path in
+    # ProjectDir or None if an input is outside of it
+    pdir = job.o_Target.s_ProjectDir
+    files = {}
+    for file in job.a_Inputs + deps:
+      path = self.Relative(file, pdir)
+      if path is None:
+        if file in job.a_Inputs: return None
+        continue
+      if path in files: continue
+      with open(file, 'rb') as f:
+        files[path] = _worker.Encode(f.read())
+    return files
+    
+  def Run(self, job):
+    # returns (returncode, stdout, stderr) like Rule.RunCmd or None if job
+    # has to run locally
+    t = job.o_Target
+    pdir = t.s_ProjectDir
+    cargs = CompileArgs(CommandArgs(job.s_Cmd), pdir)
+    if cargs is None or job.a_Parts or job.s_RspFile: 
+      return None
+    with self.l_Lock: self.i_Local += 1
+    try:
+      c = _compile.Compilation(cargs, pdir, t.h_Env)
+      outputs = [self.Relative(out, pdir) for out in job.a_Outputs]
+      if c.b_DepFile: outputs.append(self.Relative(c.s_DepFile, pdir))
+      if None in outputs or not c.s_Out: return None
+      deps = RecordedDeps(job.a_Outputs, t.s_DepDir)
+      recorded = bool(deps)
+      if not recorded: deps = c.ScanDeps()
+      files = self.Files(job, deps)
+      if files is None: return None
+    except OSError:
+      return None
+    address = self.Pick()
+    if address is None: return None
+    
+    def run(cmd):
+      msg = {'files': files, 'outputs': outputs,
+        'args': [arg.replace(pdir, '') for arg in cmd]}
+      reply = _worker.Request(address, self.s_Token, msg, self.i_Timeout)
+      if 'error' in reply: raise ValueError(reply['error'])
+      if reply['ret'] == 0:
+        for path in outputs:
+          if not path in reply['files']: continue
+          file = os.path.join(pdir, path)
+          os.makedirs(os.path.dirname(file), exist_ok=True)
+          with open(file + '.tmp', 'wb') as f:
+            f.write(_worker.Decode(reply['files'][path]))
+          os.replace(file + '.tmp', file)
+      return reply['ret'], _worker.Decode(reply['out']), _worker.Decode(reply['err'])
+    
+    out = io.StringIO()
+    err = io.StringIO()
+    start = time.perf_counter()
+    try:
+      ret = c.CompileWith(run, out, err)
+    except (OSError, ValueError, KeyError):
+      with self.l_Lock: self.h_Down[address] = time.monotonic()
+      # reported with the output of the job when it ran locally
+      job.b_Err += ("Worker %s:%d failed: %s\n" % (address + 
+        (sys.exc_info()[1],))).encode()
+      return None
+    finally:
+      with self.l_Lock: self.h_Running[address] -= 1
+    # the recorded headers may be outdated if the source changed, the local
+    # run gives the real error then
+    if ret != 0 and recorded: return None
+    if Trace:
+      for name, s, e in c.a_Spans:
+        Trace.Add(name, 'compile.py', s, e)
+      Trace.Add('run on %s:%d' % address, 'worker', start, time.perf_counter())
+    with self.l_Lock:
+      self.i_Local -= 1
+      self.i_Remote += 1
+    enc = sys.stdout.encoding or 'utf-8'
+    return ret, out.getvalue().encode(enc, 'replace'), err.getvalue().encode(enc, 'replace')
+    
+Workers = None
+
 ###############################################################################
 # Property handling for rules
 
 # shared properties
 class ToolProperty:
   def __init__(self, node):
-    self.s_Name = node.getAttribute("Name")
+    self.s_Name = node.get("Name", "")
   
 class StringProperty(ToolProperty):
   def __init__(self, node):
     super().__init__(node)
-    self.s_Delimited  = node.getAttribute("Delimited")  or 'false'
-    self.s_Delimiters = node.getAttribute("Delimiters") or ";,"
-    self.s_Switch     = node.getAttribute("Switch")     or ""
-    self.s_DefaultValue = node.getAttribute("DefaultValue")     or ""
+    self.s_Delimited  = node.get("Delimited")  or 'false'
+    self.s_Delimiters = node.get("Delimiters") or ";,"
+    self.s_Switch     = node.get("Switch")     or ""
+    self.s_DefaultValue = node.get("DefaultValue")     or ""
   
   def Apply(self, setting):
     setting = setting or self.s_DefaultValue
@@ -172,11 +1352,11 @@ class EnumProperty(ToolProperty):
   def __init__(self, node):
     super().__init__(node)
     self.h_Values = {}
-    self.s_DefaultValue = node.getAttribute("DefaultValue") or "0"
-    values = getFirstElementByTagName(node, "Values")
-    for val in getDirectElementsByTagName(values, "EnumValue"):
-      switch = val.getAttribute("Switch")  or ''
-      value  = val.getAttribute("Value")   or '0'
+    self.s_DefaultValue = node.get("DefaultValue") or "0"
+    values = node.find("Values")
+    for val in values.findall("EnumValue"):
+      switch = val.get("Switch")  or ''
+      value  = val.get("Value")   or '0'
       self.h_Values[value] = switch
     
   def Apply(self, setting):
@@ -189,8 +1369,8 @@ class EnumProperty(ToolProperty):
 class BooleanProperty(ToolProperty):
   def __init__(self, node):
     super().__init__(node)
-    self.s_DefaultValue = node.getAttribute("DefaultValue") or "false"
-    self.s_Switch       = node.getAttribute("Switch")       or ""
+    self.s_DefaultValue = node.get("DefaultValue") or "false"
+    self.s_Switch       = node.get("Switch")       or ""
     
   def Apply(self, setting):
     v = setting or 'false'
@@ -206,28 +1386,32 @@ Rules = {}
 r_FileSplit = re.compile('"(.*?)"|(.*?)'+os.pathsep)
 #r_FileSplit = re.compile('"(.*?)"')
 r_argResolverRe = re.compile('\[(.*?)\]')
+# longest command line passed without a response file
+i_MaxCommandLine = 8000 if os.name == 'nt' else 100000
 
 class Rule:
 
   def __init__(self, node):
     # load 
     self.a_Properties = []
-    self.s_Name           = node.getAttribute("Name")
+    self.s_Name           = node.get("Name", "")
     if len(self.s_Name) == 0: raise
     Rules[self.s_Name] = self
-    self.s_FileExtensions = node.getAttribute("FileExtensions")
+    self.s_FileExtensions = node.get("FileExtensions", "")
     self.CompileExtensionRegex()
-    self.s_CommandLine    = node.getAttribute("CommandLine")
-    self.s_Outputs        = node.getAttribute("Outputs")
-    self.s_ExecutionDesc  = node.getAttribute("ExecutionDescription")
-    self.s_SupportsFileBatching = node.getAttribute("SupportsFileBatching") or 'false'
-    self.s_BatchingSeparator    = node.getAttribute("BatchingSeparator")
-    props = getDirectElementsByTagName(node, "Properties")
-    if props:
-      for prop in props[0].childNodes:
-        if prop.nodeType != dom.Node.ELEMENT_NODE: continue
-        pname = prop.getAttribute("Name")  
-        prop = eval(prop.tagName + "(prop)")
+    self.s_CommandLine    = node.get("CommandLine", "")
+    self.s_Outputs        = node.get("Outputs", "")
+    self.s_ExecutionDesc  = node.get("ExecutionDescription", "")
+    self.s_SupportsFileBatching = node.get("SupportsFileBatching") or 'false'
+    self.s_BatchingSeparator    = node.get("BatchingSeparator", "")
+    # resource limits, see JobPool.Fits
+    self.i_MaxParallel = int(node.get("MaxParallel") or 0)
+    self.i_MemoryUsage = int(node.get("MemoryUsage") or 0) # MB per command
+    props = node.find("Properties")
+    if props is not None:
+      for prop in props:
+        pname = prop.get("Name")  
+        prop = eval(prop.tag + "(prop)")
         self.a_Properties.append( prop )
         
   
@@ -240,41 +1424,56 @@ class Rule:
   
   def Match(self, ext):
     return self.r_FileExtensions.match(ext)
+    
+  def Extensions(self):
+    # the extensions if s_FileExtensions only has *.xyz patterns, these
+    # are looked up in the FileRegistry index, None otherwise
+    exts = []
+    for pattern in self.s_FileExtensions.split(';'):
+      ext = pattern[1:]
+      if not pattern.startswith('*.') or [c for c in ext[1:] if c in '*?./\\']:
+        return None
+      if not ext in exts: exts.append(ext)
+    return exts
   
   
-  def RunCmd(self, cmd):
+  # returns (returncode, stdout, stderr), the output is captured
+  def RunCmd(self, cmd, cwd=None, env=None):
     #print(os.path.abspath(".")+':', cmd)
+    args = CommandArgs(cmd)
+    cargs = CompileArgs(args, cwd) if b_InProcess else None
+    if cargs is not None:
+      return RunInProcess(cargs, cwd, env)
+    fds = Jobserver.a_Fds if Jobserver else ()
     try:
-      #ret = subprocess.call(cmd)
-      proc = subprocess.Popen(cmd, stdout=sys.stdout, stderr=sys.stderr, shell=True )
-      proc.communicate()
-      ret = proc.returncode
-      
-      
-      if ret != 0:
-        print( cmd , file=sys.stderr )
-        print("Returned with error", ret)
-        exit(ret)
+      try:
+        # plain commands are started directly instead of through a shell
+        if args is None: raise FileNotFoundError
+        proc = subprocess.Popen(args, stdout=subprocess.PIPE, 
+          stderr=subprocess.PIPE, cwd=cwd, env=env, pass_fds=fds )
+      except FileNotFoundError:
+        # shell syntax or a shell builtin like copy
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, 
+          stderr=subprocess.PIPE, shell=True, cwd=cwd, env=env, pass_fds=fds )
+      out, err = proc.communicate()
+      return proc.returncode, out, err
     except:
-      print( cmd , file=sys.stderr )
-      print( sys.exc_info()[1], file=sys.stderr )
-      exit(-1)
+      return -1, b"", (str(sys.exc_info()[1]) + "\n").encode()
       
   def GetOutDir(self):
-    SetInput("ndse.tmp", ProjectDir)
-    outs = ResolveMacros(self.s_Outputs)
+    ctx = InputContext("ndse.tmp", ProjectDir)
+    outs = ResolveMacros(self.s_Outputs, ctx)
     return os.path.dirname(outs)
       
-  def RunCmdInPDir(self, cmd):
-    cur = os.getcwdb()
+  # the working directory is passed to the process instead of changing
+  # the cwd of PyBuild, so parallel jobs dont race on it
+  def RunCmdInPDir(self, cmd, pdir=None, env=None):
     #odir = self.GetOutDir()
-    odir = ProjectDir
+    odir = pdir or ProjectDir
     if odir:
       if not os.path.exists(odir):
         os.mkdir(odir)
-      os.chdir(odir)
-    self.RunCmd(cmd)
-    os.chdir(cur)
+    return self.RunCmd(cmd, odir or None, env)
   
   
   def Clean(self, files, attribs):
@@ -283,11 +1482,11 @@ class Rule:
       if prop.s_Name == "OutputFile":
         out_arg = attribs.get(prop.s_Name) or prop.s_DefaultValue
     for file in files:
-      SetInput(file, ProjectDir)
+      ctx = InputContext(file, ProjectDir)
       if out_arg:
-        outs = ResolveMacros(out_arg)
+        outs = ResolveMacros(out_arg, ctx)
       else:
-        outs = ResolveMacros(self.s_Outputs)
+        outs = ResolveMacros(self.s_Outputs, ctx)
       for out in r_FileSplit.split(outs):
         if not out: continue
         fname = AbsrelPath(out, ProjectDir)
@@ -298,25 +1497,16 @@ class Rule:
   
   
   
-  def ResolveArgMacro(self, m):
-    s = m.group(1)
-    a = self.h_Args.get(s)
-    if a != None : return a
-    return "[" + s + "]"
-
-  
-  def ResolveArgMacros(self, s):
-    if s.find('[') == -1: return ResolveMacros(s) # dont spam console   
-    s = r_argResolverRe.sub(self.ResolveArgMacro, s)
-    
-    #if s.find('[') != -1:
-    #  print("WARNING:", s, "contains [")
-    #  exit(0)
-
-    return ResolveMacros(s)
+  def ResolveArgMacros(self, s, ctx=None):
+    return MacroTemplate(s, self.h_Args).Render(ctx)
   
   # redo handling of OutputFile!
-  def Execute(self, files, attribs, additionalArgs):
+  # Adds the jobs for the outdated files to graph, they are run once the
+  # whole build is planned
+  # implicit maps a file to the further inputs of its job, like the members
+  # of a unity file
+  def Execute(self, files, attribs, additionalArgs, graph, bucket, 
+    implicit={}):
     # iterate over all properties and build their command line tokens
     # collect the full command line in s_allArgs for [AllOptions]
     self.h_Args = {}
@@ -329,73 +1519,174 @@ class Rule:
       s_allArgs += pval
     self.h_Args['AllOptions'] = s_allArgs
     self.h_Args['AdditionalOptions'] = additionalArgs
+    
+    # compile the templates once for all files
+    t_Outputs = MacroTemplate(self.s_Outputs, self.h_Args)
+    t_Command = MacroTemplate(self.s_CommandLine, 
+      dict(self.h_Args, Inputs=s_InputsSlot))
+    t_Desc    = MacroTemplate(self.s_ExecutionDesc)
 
     
-    # TODO: redo rebuild policy
-    # currently rebuild is only checked against s_Output generated files!
-    #
     # preprocess files
-    # check what files need to be rebuild
+    # check what files are outdated by their file times, this is only used
+    # for jobs without a recorded signature (see Outdated)
     # add expected output to outputs
-    a_Rebuild = []
+    # files generated by a job of this build are always outdated, they
+    # might not even exist yet
+    a_Rebuild = set()
+    h_Outputs = {}
     for file in files:
-      SetInput(file, ProjectDir)          # set macros for this file
-      ftime = os.path.getmtime(InputPath) # get last access of this file
-      outs = self.ResolveArgMacros(self.s_Outputs)
+      ctx = InputContext(file, ProjectDir)       # macros for this file
+      ftime = None
+      if not graph.Producer(file):
+        st = Stats.Stat(file)  # get last access of this file
+        if st is None:
+          print( "File not found:", file, file=sys.stderr )
+          exit(-1)
+        ftime = st[0]
+      for dep in implicit.get(file, ()):
+        st = Stats.Stat(dep)
+        if ftime is not None and st is not None: ftime = max(ftime, st[0])
+      outs = t_Outputs.Render(ctx)
+      h_Outputs[file] = []
       for out in r_FileSplit.split(outs):
         if not out: continue
-        fname = AbsrelPath(out, ProjectDir)
-        if not os.path.exists(fname):
-          if not (file in a_Rebuild): a_Rebuild.append(file)
-        else:
-          otime = os.path.getmtime(fname)
-          if (ftime >= otime) and not (file in a_Rebuild):
-            a_Rebuild.append(file)
-        AddFile(fname)
+        fname = AddFile(AbsrelPath(out, ProjectDir), self.s_Name)
+        ost = Stats.Stat(fname)
+        if ftime is None or ost is None or ftime >= ost[0]:
+          a_Rebuild.add(file)
+        h_Outputs[file].append(fname)
    
     
  
-    # RECHECK AND REDO THIS (support response files somehow!)
-    # => figure how VC uses them (probably compiler magic ...)
-    #    if so use some magic that doesnt clash with VC...
-
     # batch processing mode
     if self.s_SupportsFileBatching == 'true':      
-      # VC passes all files no matter if they are out of date or not
-      # unless all files are up to date
-      s_Rebuild = ""
-      needRebuild = False
-      for file in files:
-        s_Rebuild += '"' + RelPath(file, ProjectDir) + '" '
-        if file in a_Rebuild: needRebuild = True
-      if needRebuild:  
-        self.h_Args['Inputs'] = s_Rebuild.rstrip()
-        cmd = self.ResolveArgMacros(self.s_CommandLine)   
-        self.RunCmdInPDir(cmd)
+      self.ExecuteBatched(files, h_Outputs, a_Rebuild, t_Command, graph, 
+        bucket, implicit)
       return
 
     
-    # sequential processing mode
+    # per file processing mode, the outdated files are run in parallel
     for file in files:
-      if not (file in a_Rebuild):
+      if not h_Outputs[file]:
         continue
       
-      SetInput(file, ProjectDir)
-      self.h_Args['Inputs'] = RelPath(InputPath, ProjectDir)
-      cmd = self.ResolveArgMacros(self.s_CommandLine)      
+      ctx = InputContext(file, ProjectDir)
+      cmd = t_Command.Render(ctx, RelPath(ctx['InputPath'], ProjectDir))
       
       #cmd = "cmd.exe /C echo " + cmd #+ ">nul"
-      print( ResolveMacros(self.s_ExecutionDesc) )
-      self.RunCmdInPDir(cmd)
+      desc = t_Desc.Render(ctx)
+      job = Job(self, cmd, desc, [file] + implicit.get(file, []), 
+        h_Outputs[file])
+      if self.Outdated(job, file in a_Rebuild, graph):
+        graph.Add(job, bucket)
+      
+  # Batching rules with an output per file are split into one chunk per
+  # job slot, each only getting the outdated files unless the command line 
+  # uses $(BatchListFull). Rules sharing their outputs between files (like
+  # a linker) get all files in a single command as VC does.
+  def ExecuteBatched(self, files, h_Outputs, a_Rebuild, t_Command, graph, 
+    bucket, implicit):
+    outputs = {}
+    shared = False
+    for file in files:
+      for out in h_Outputs[file]:
+        if out in outputs: shared = True
+        outputs[out] = None
+    if not outputs: return
+    
+    if shared:
+      # VC passes all files no matter if they are out of date or not
+      # unless all files are up to date
+      job = Job(self, None, None, files, outputs)
+      for file in files: job.a_Inputs += implicit.get(file, [])
+      self.BatchCommand(job, t_Command, files, "ndselist")
+      if self.Outdated(job, bool(a_Rebuild.intersection(files)), graph):
+        graph.Add(job, bucket)
+      return
+    
+    # the signatures are kept per file, using the command line the file
+    # would have on its own so they dont depend on the chunking
+    parts = []
+    outdated = False
+    for file in files:
+      if not h_Outputs[file]: continue
+      ctx = InputContext(file, ProjectDir)
+      cmd = t_Command.Render(ctx, RelPath(file, ProjectDir))
+      part = Job(self, cmd, None, [file] + implicit.get(file, []), 
+        h_Outputs[file])
+      part.b_Outdated = self.Outdated(part, file in a_Rebuild, graph)
+      outdated = outdated or part.b_Outdated
+      parts.append(part)
+    if self.s_CommandLine.find('$(BatchListFull)') == -1:
+      parts = [part for part in parts if part.b_Outdated]
+    elif not outdated:
+      parts = []
+    if not parts: return
+    
+    # balance the chunks by the expected time of their files, an exported
+    # build gets a single batch as ninja cant split it
+    slots = 1 if graph.b_All else Pool.i_Jobs
+    chunks = [[0, i, []] for i in range(min(slots, len(parts)))]
+    weights = Estimates(parts)
+    for part in sorted(parts, key=lambda part: -weights[part]):
+      chunk = heapq.heappop(chunks)
+      chunk[0] += weights[part]
+      chunk[2].append(part)
+      heapq.heappush(chunks, chunk)
+    order = dict((part, i) for i, part in enumerate(parts))
+    for weight, i, chunk in sorted(chunks, key=lambda chunk: chunk[1]):
+      chunk.sort(key=order.get)
+      inputs = []
+      outputs = []
+      for part in chunk:
+        inputs += part.a_Inputs
+        outputs += part.a_Outputs
+      job = Job(self, None, None, inputs, outputs)
+      job.a_Parts = chunk
+      # the implicit inputs of the parts are not on the command line
+      self.BatchCommand(job, t_Command, [part.a_Inputs[0] for part in chunk], 
+        "ndselist_%s_%d" % (SafeName(self.s_Name), i))
+      graph.Add(job, bucket)
+      
+  def BatchCommand(self, job, t_Command, files, name):
+    # resolves the command line of a batch, $(BatchList) is a response file
+    # listing the files. If the command line gets too long [Inputs] is
+    # passed as a response file as well.
+    rsp = IntermediateDirectory + name + ".rsp"
+    inputs = " ".join(['"' + RelPath(file, ProjectDir) + '"' for file in files])
+    ctx = {'BatchList': rsp, 'BatchListFull': rsp}
+    job.s_Cmd = t_Command.Render(ctx, inputs)
+    b_Rsp = job.s_Cmd.find(rsp) != -1
+    if len(job.s_Cmd) > i_MaxCommandLine:
+      job.s_Cmd = t_Command.Render(ctx, '@"' + RelPath(rsp, ProjectDir) + '"')
+      b_Rsp = True
+    if b_Rsp:
+      job.s_RspFile = rsp
+      job.s_RspContent = inputs.replace('" "', '"\n"') + "\n"
+  
+  def Outdated(self, job, stale, graph):
+    # stale tells if job is outdated by its file times, which is only used
+    # until a signature of job got recorded
+    if graph.b_All: return True
+    for file in job.a_Inputs:
+      if graph.Producer(file): return True
+    upToDate = Signatures.UpToDate(job)
+    if upToDate is None:
+      if not stale: Signatures.Record(job)
+      return stale
+    return not upToDate
  
 
+RuleFiles = []
 def LoadRulefile(file):
-  x = dom.parse(file)
-  f = getFirstElementByTagName(x, 'VisualStudioToolFile')
-  rules = getFirstElementByTagName(f, 'Rules')
-  cbrules = getDirectElementsByTagName(rules, 'CustomBuildRule')
-  for rule in cbrules:
-    Rule(rule)
+  RuleFiles.append(file)
+  for event, path, elem in StreamElements(file, ('CustomBuildRule',)):
+    if event != 'end': continue
+    if path == ['VisualStudioToolFile', 'Rules']:
+      if elem.tag == 'CustomBuildRule': Rule(elem)
+    elif path == ['VisualStudioToolFile'] and elem.tag == 'Rules':
+      break # only the first Rules are used
 
 
 
@@ -404,48 +1695,137 @@ def LoadRulefile(file):
 
 class ToolConfig:
   def __init__(self, node, index):
-    self.s_Name = node.getAttribute("Name")
+    self.s_Name = node.get("Name", "")
     if not self.s_Name in Rules:
       print( "Tool not known:", self.s_Name , file=sys.stderr )
       exit(-1)
     self.r_Rule = Rules[self.s_Name]
     self.h_Attributes = {}
-    attr = node.attributes
     self.i_ExecutionBucket = index
+    self.i_MaxParallel = self.r_Rule.i_MaxParallel
+    self.i_MemoryUsage = self.r_Rule.i_MemoryUsage
+    self.b_Unity = False
+    self.i_UnitySize = 8
     self.s_AdditionalOptions = ""
-    for i in range(attr.length):
-      a = attr.item(i)
-      if (a.name == "Name") : continue
-      if (a.name == "AdditionalOptions"):
-        self.s_AdditionalOptions = a.nodeValue
+    for name, value in node.attrib.items():
+      if (name == "Name") : continue
+      if (name == "AdditionalOptions"):
+        self.s_AdditionalOptions = value
+        continue
+      if (name == "ExecutionBucket"):
+        self.i_ExecutionBucket = int(value)
+        continue
+      if (name == "MaxParallel"):
+        self.i_MaxParallel = int(value)
+        continue
+      if (name == "MemoryUsage"):
+        self.i_MemoryUsage = int(value)
+        continue
+      if (name == "UnityBuild"):
+        self.b_Unity = value.lower() == "true"
         continue
-      if (a.name == "ExecutionBucket"):
-        self.i_ExecutionBucket = int(a.nodeValue)
+      if (name == "UnitySize"):
+        self.i_UnitySize = max(1, int(value))
         continue
-      self.ValidateAttribute(a)
-      self.h_Attributes[a.name] = a.nodeValue
+      self.ValidateAttribute(name)
+      self.h_Attributes[name] = value
 
     
-  def ValidateAttribute(self, node):
+  def ValidateAttribute(self, name):
     # Debugging function verifies if the selected rule has the given property
     for prop in self.r_Rule.a_Properties:
-      if prop.s_Name == node.name: return
-    print("Warning: Attribute", node.name, "is not defined in Rule", 
+      if prop.s_Name == name: return
+    print("Warning: Attribute", name, "is not defined in Rule", 
       self.r_Rule.s_Name)
     exit(-1)
     
   def Match(self, files):
-    matched = []
-    for file in files:
-      if self.r_Rule.Match(file): matched.append(file)
-    return matched
+    return files.Matching(self.r_Rule)
     
   # Single file processing
-  def Process(self, files):
-    self.r_Rule.Execute(files, self.h_Attributes, self.s_AdditionalOptions)
+  def Process(self, files, graph):
+    graph.o_Tool = self
+    implicit = {}
+    if self.b_Unity:
+      files, implicit = self.Unity(files)
+    self.r_Rule.Execute(files, self.h_Attributes, self.s_AdditionalOptions,
+      graph, self.i_ExecutionBucket, implicit)
     
   def Clean(self, files):
+    if self.b_Unity:
+      files = list(files) + [os.path.join(IntermediateDirectory, name) 
+        for name in self.LoadUnityGroups()]
     self.r_Rule.Clean(files, self.h_Attributes)
+    
+  #############################################################################
+  # Unity builds
+  #
+  # With UnityBuild="true" the files of the tool are compiled in groups of
+  # UnitySize, each group being a unity file in the IntermediateDirectory
+  # that includes its members. Diagnostics point at the members as they
+  # are included by their path. The groups are kept in a json file, a file
+  # keeps its group as long as it exists, new files go to the first group
+  # of their extension with room left. So adding or changing a file only
+  # rebuilds its group. Unity files are only written when their members
+  # changed, the members are implicit inputs of the job of their group.
+  
+  def UnityGroupsFile(self):
+    return os.path.join(IntermediateDirectory, 
+      'unity_%s.json' % SafeName(self.s_Name))
+    
+  def LoadUnityGroups(self):
+    # returns the members of the unity files by their name, with the paths
+    # relative to ProjectDir
+    try:
+      with open(self.UnityGroupsFile()) as f:
+        return json.load(f)['groups']
+    except (OSError, ValueError, KeyError):
+      return {}
+    
+  def Unity(self, files):
+    # returns the unity files for files and the members of each of them
+    paths = [RelPath(file, ProjectDir) for file in files]
+    known = set(paths)
+    groups = {}
+    placed = set()
+    old = self.LoadUnityGroups()
+    for name, members in old.items():
+      members = [m for m in members if m in known and not m in placed]
+      if not members: continue
+      groups[name] = members
+      placed.update(members)
+    for path in paths:
+      if path in placed: continue
+      ext = os.path.splitext(path)[1]
+      free = [name for name in groups if os.path.splitext(name)[1] == ext
+        and len(groups[name]) < self.i_UnitySize]
+      if free:
+        name = free[0]
+      else:
+        i = 1
+        while ('unity_%s_%d%s' % (SafeName(self.s_Name), i, ext)) in groups: i += 1
+        name = 'unity_%s_%d%s' % (SafeName(self.s_Name), i, ext)
+        groups[name] = []
+      groups[name].append(path)
+      placed.add(path)
+    if groups != old:
+      WriteJson(self.UnityGroupsFile(), {'groups': groups})
+    
+    unity = []
+    implicit = {}
+    for name, members in groups.items():
+      file = NormFile(os.path.join(IntermediateDirectory, name))
+      lines = ["/* unity file of %s generated by build.py, do not edit */" 
+        % self.s_Name]
+      for path in members:
+        include = RelPath(os.path.join(ProjectDir, path), IntermediateDirectory)
+        lines.append('#include "%s"' % include.replace('\\', '/'))
+      WriteIfChanged(file, "\n".join(lines) + "\n")
+      Stats.Invalidate(file)
+      unity.append(file)
+      implicit[file] = [NormFile(os.path.join(ProjectDir, path)) 
+        for path in members]
+    return unity, implicit
 
 ###############################################################################
 # Project file support
@@ -456,16 +1836,16 @@ Configurations = {}
 
 class Configuration:
   def __init__(self, node):
-    self.s_Name, self.s_Platform = node.getAttribute("Name").split('|')
-    self.s_OutputDirectory       = node.getAttribute("OutputDirectory")
-    self.s_IntermediateDirectory = node.getAttribute("IntermediateDirectory")
+    self.s_Name, self.s_Platform = node.get("Name", "").split('|')
+    self.s_OutputDirectory       = node.get("OutputDirectory", "")
+    self.s_IntermediateDirectory = node.get("IntermediateDirectory", "")
     Configurations[self.s_Name] = self
     
     # load Tools
     self.h_Tools = {}
     self.h_ExecutionBucket = {}
     i = 1
-    for tool in getDirectElementsByTagName(node, "Tool"):
+    for tool in node.findall("Tool"):
       #ExecutionBucket
       t = ToolConfig(tool, i)
       self.h_Tools[t.s_Name] = t
@@ -488,14 +1868,20 @@ class Configuration:
     OutDir = RelPath(OutputDirectory, ProjectDir)
     IntDir = RelPath(IntermediateDirectory, ProjectDir)
       
-  def Build(self):
-    self.Prepare()
-    print( "------ Build started: Project:", ProjectName +  
+  def Plan(self, graph):
+    print( "------", "Export" if graph.b_All else "Build", "started: Project:", 
+      ProjectName +  
       ", Configuration:", self.s_Name, "------") 
+    # the tools expect the directories to exist as VC creates them
+    os.makedirs(IntermediateDirectory, exist_ok=True)
+    os.makedirs(OutputDirectory, exist_ok=True)
+    # plan all buckets first, the outputs of a bucket are registered in
+    # Files so later buckets match them
     for i in range(1, len(self.h_ExecutionBucket) + 1):
       rule = self.h_ExecutionBucket[i]
-      matched = rule.Match(Files)
-      rule.Process(matched)    
+      with Span('bucket %d: %s' % (i, rule.s_Name), 'plan'):
+        matched = rule.Match(Files)
+        rule.Process(matched, graph)
   
   def Clean(self):
     self.Prepare()
@@ -506,50 +1892,557 @@ class Configuration:
       matched = rule.Match(Files)
       rule.Clean(matched)
     
-def CollectFiles(node):
-  for dir in getDirectElementsByTagName(node, "Filter"):
-    CollectFiles(dir)
-    
-  for file in getDirectElementsByTagName(node, "File"):
-    filename = file.getAttribute("RelativePath")
-    AddFile(AbsrelPath(filename, ProjectDir))
-  
-def LoadProjectfile(file):
+def SetProject(file):
   global InputDir, ProjectDir
   global InputExt, ProjectExt
   global InputFileName, ProjectFileName
   global InputName, ProjectName
   global InputPath, ProjectPath
 
-  SetInput(file, os.curdir)
+  # the paths of the files are relative to the real ProjectDir, which may
+  # not be the one of a symlink
+  SetInput(os.path.realpath(file), os.curdir)
   ProjectDir = InputDir
   ProjectExt = InputExt
   ProjectName = InputName
   ProjectFileName = InputFileName
   ProjectPath = InputPath 
-  
-  x = dom.parse(file)
-  f = getFirstElementByTagName(x, 'VisualStudioProject')
+
+# The project is streamed, only the first ToolFiles, Configurations and
+# Files sections are used. Within Files the files of every Filter are
+# collected depth first before the Files next to it.
+def LoadProjectfile(file):
+  SetProject(file)
   
   # Todo: ProjectName probably is the Filename - verify this!
-  # ProjectName = f.getAttribute("Name")
+  # ProjectName = root.get("Name")
   
-  # load all rules
-  tools = getDirectElementsByTagName(f, "ToolFiles")
-  if tools:
-    for tool in getDirectElementsByTagName(tools[0], "ToolFile"):
-      stool = AbsrelPath( tool.getAttribute("RelativePath"), ProjectDir )
+  root = ['VisualStudioProject']
+  seen = []     # sections already loaded
+  configs = []  # loaded once all rules are known
+  scopes = []   # [depth, files of sub filters, files] of open Files/Filter
+  for event, path, elem in StreamElements(file, ('Configuration',)):
+    tag = elem.tag
+    if event == 'start':
+      if (tag == 'Files') and (path == root) and not (tag in seen):
+        scopes.append([len(path), [], []])
+      elif (tag == 'Filter') and scopes and (len(path) == scopes[-1][0] + 1):
+        scopes.append([len(path), [], []])
+      continue
+    
+    if not path:
+      continue
+    elif path == root:
+      if (tag == 'Files') and scopes:
+        depth, filters, files = scopes.pop()
+        for filename in filters + files:
+          AddFile(AbsrelPath(filename, ProjectDir))
+      seen.append(tag)
+    elif path[1] in seen: 
+      continue
+    elif (tag == 'ToolFile') and (path == root + ['ToolFiles']):
+      # load all rules
+      stool = AbsrelPath( elem.get("RelativePath", ""), ProjectDir )
       print("Loading Tool:", stool)
       LoadRulefile( stool )
+    elif (tag == 'Configuration') and (path == root + ['Configurations']):
+      configs.append(elem)
+    elif scopes and (len(path) == scopes[-1][0] + 1) and (tag == 'File'):
+      scopes[-1][2].append(elem.get("RelativePath", ""))
+    elif scopes and (len(path) == scopes[-1][0]) and (tag == 'Filter'):
+      depth, filters, files = scopes.pop()
+      scopes[-1][1].extend(filters + files)
   
   # load configurations
-  configs = getFirstElementByTagName(f, "Configurations")
-  for config in getDirectElementsByTagName(configs, "Configuration"):
+  for config in configs:
     Configuration(config)
+
+###############################################################################
+# Build manifest
+
+# After a successful build the stamps of every file it depends on are
+# written to a manifest: project and rule files, all inputs and outputs,
+# the recorded headers and PyBuild itself. If none of them changed the
+# next build is done after a single pass of stats, without even parsing
+# the project.
+
+def ManifestFile(project):
+  dir, name = os.path.split(AbsrelPath(project, os.curdir))
+  return os.path.join(dir, '.pybuild', name + '.manifest')
+
+def Stamp(file):
+  st = Stats.Stat(file)
+  return st and list(st)
+
+def LoadManifest(project):
+  try:
+    with open(ManifestFile(project)) as f:
+      data = json.load(f)
+    if isinstance(data['configs'], dict): return data
+  except (OSError, ValueError, KeyError):
+    pass
+  return {'default': None, 'configs': {}}
+
+# the manifest of the current configuration, every configuration built
+# gets its own entry
+def WriteManifest(project, config):
+  here = os.path.dirname(os.path.abspath(__file__))
+  files = [project, os.path.join(here, 'build.py'), 
+    os.path.join(here, 'compile.py')]
+  files += RuleFiles + list(Files) 
+  files += RecordedDeps(Files.Outputs(), os.path.join(IntermediateDirectory, 'deps'))
+  stamps = {}
+  for file in files:
+    stamps[AbsrelPath(file, os.curdir)] = Stamp(file)
+  data = LoadManifest(project)
+  data['default'] = list(Configurations)[-1]
+  data['configs'][config] = {'env': UsedEnv, 'stamps': stamps}
+  file = ManifestFile(project)
+  os.makedirs(os.path.dirname(file), exist_ok=True)
+  with open(file + '.tmp', 'w') as f:
+    json.dump(data, f)
+  os.replace(file + '.tmp', file)
+  
+def ManifestUpToDate(project, config=None):
+  # returns the name of config, or of the default configuration if it is
+  # None, if nothing changed since it was built, otherwise None
+  data = LoadManifest(project)
+  config = config or data['default']
+  entry = data['configs'].get(config)
+  if not entry: return None
+  for name, value in entry['env'].items():
+    if os.environ.get(name) != value: return None
+  for file, stamp in entry['stamps'].items():
+    if Stamp(file) != stamp: return None
+  return config
+
+
+###############################################################################
+# Project model cache
+
+# The loaded model (Rules, Configurations, Files) is pickled next to the
+# manifest together with the stamps of the files it was loaded from. As
+# long as they are unchanged the model is unpickled instead of parsing 
+# the XML again.
+
+def ModelFile(project):
+  return os.path.splitext(ManifestFile(project))[0] + '.model'
+
+def LoadProject(project):
+  global Rules, Configurations, Files, RuleFiles
+  file = ModelFile(project)
+  try:
+    with open(file, 'rb') as f:
+      data = pickle.load(f)
+    for name, stamp in data['stamps'].items():
+      if Stamp(name) != stamp: raise ValueError(name)
+    SetProject(project)
+    Rules, Configurations, Files, RuleFiles = data['model']
+    return
+  except Exception:
+    pass
+  
+  Rules = {}
+  Configurations = {}
+  Files = FileRegistry()
+  RuleFiles = []
+  LoadProjectfile(project)
+  here = os.path.dirname(os.path.abspath(__file__))
+  stamps = {}
+  for name in [project, os.path.join(here, 'build.py')] + RuleFiles:
+    stamps[AbsrelPath(name, os.curdir)] = Stamp(name)
+  data = {'stamps': stamps, 
+    'model': (Rules, Configurations, Files, list(RuleFiles))}
+  os.makedirs(os.path.dirname(file), exist_ok=True)
+  with open(file + '.tmp', 'wb') as f:
+    pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+  os.replace(file + '.tmp', file)
+
+
+###############################################################################
+# Build targets
+
+# The state of the project and configuration being loaded or planned is
+# kept in module globals, where the macros find it. A target saves that
+# state for one project and configuration, so several targets can be
+# planned one after the other and then run in a single pool. Running jobs
+# only use the state saved in their target, never the globals.
+
+a_ProjectState = ['InputDir', 'InputExt', 'InputFileName', 'InputName', 
+  'InputPath', 'ProjectDir', 'ProjectExt', 'ProjectName', 'ProjectFileName',
+  'ProjectPath', 'Rules', 'Configurations', 'Files', 'RuleFiles']
+a_ConfigState = ['ConfigurationName', 'PlatformName', 'IntermediateDirectory',
+  'IntDir', 'OutputDirectory', 'OutDir', 'Signatures']
+
+def SaveState(names):
+  return dict((name, globals().get(name)) for name in names)
+
+class Target:
+  def __init__(self, project, config):
+    # project is the saved state of a loaded project
+    self.h_Project = project
+    self.c_Config = config
+    self.o_Signatures = None
+    self.Reset()
+    
+  def Reset(self):
+    # Every target gets its own Files, as planning registers the outputs
+    # of the configuration. Reset starts over from the project files.
+    self.h_State = dict(self.h_Project)
+    self.h_State['Files'] = copy.deepcopy(self.h_Project['Files'])
+    self.Select()
+    self.c_Config.Prepare()
+    self.s_ProjectDir = ProjectDir
+    self.s_DepDir = os.path.join(IntermediateDirectory, 'deps')
+    if not self.o_Signatures:
+      self.o_Signatures = SignatureDb(
+        os.path.join(IntermediateDirectory, 'signatures.json'), self.s_DepDir)
+    # the header dependency database of compile.py, which does not have to
+    # check the jobs build.py found outdated again
+    self.h_Env = dict(os.environ, PYBUILD_DEPDB=self.s_DepDir, 
+      PYBUILD_CHECKED='1')
+    global Signatures
+    Signatures = self.o_Signatures
+    self.h_State.update(SaveState(a_ConfigState))
+    
+  def Select(self):
+    globals().update(self.h_State)
+    
+def LoadTargets(project, cnames, all):
+  # loads project and returns the targets of the configurations cnames, None
+  # meaning the last one of the project, or of all its configurations
+  with Span('load ' + project, 'load'):
+    LoadProject(project)
+  state = SaveState(a_ProjectState)
+  if all: cnames = list(Configurations)
+  targets = []
+  for cname in cnames:
+    if cname is None: cname = list(Configurations)[-1]
+    if not cname in Configurations:
+      print( "Configuration not known:", cname, "in", project, file=sys.stderr )
+      exit(-1)
+    target = Target(state, Configurations[cname])
+    target.s_Project = project
+    targets.append(target)
+  return targets
+
+# returns 0 or the error code of the first failed job
+def BuildTargets(targets):
+  graph = BuildGraph()
+  for target in targets:
+    target.Select()
+    graph.o_Target = target
+    with Span('plan ' + ProjectName + '|' + ConfigurationName, 'plan'):
+      target.c_Config.Plan(graph)
+  graph.Finish()
+  with Span('run', 'run', {'jobs': len(graph.a_Jobs)}):
+    ret = Pool.Run(graph.a_Schedule)
+  for target in targets:
+    target.o_Signatures.Save()
+  if Cache:
+    Cache.Trim()
+    print( "------ Artifact cache:", Cache.i_Hits, "hits,", Cache.i_Misses, 
+      "misses,", Cache.i_Evicted, "evicted ------" )
+  if Workers:
+    print( "------ Workers:", Workers.i_Remote, "compiles run remotely,", 
+      Workers.i_Local, "locally ------" )
+    Workers.i_Remote = Workers.i_Local = 0
+  if ret != 0:
+    return ret
+  for target in targets:
+    target.Select()
+    WriteManifest(ProjectPath, ConfigurationName)
+    jobs = [job for job in graph.a_Jobs if job.o_Target is target]
+    print( "------ Build finished: Project:", ProjectName + ", Configuration:",
+      ConfigurationName + ",", len(jobs), "commands run ------" )
+  print( "------", Stats.Avoided(), "of", Stats.i_Lookups, 
+    "stat calls avoided ------" )
+  return 0
+
+
+###############################################################################
+# Ninja export
+
+# With --emit-ninja all jobs of the targets are written to a build.ninja in
+# their ProjectDir instead of running them, so ninja can run the builds.
+# compile.py jobs get the dependency file it writes with --depfile. The
+# build.ninja is regenerated by ninja when a project or rule file changed.
+
+def NinjaEscape(s):
+  return s.replace('$', '$$').replace('\n', ' ')
+
+def NinjaPath(file, pdir):
+  # files outside of pdir keep their full path
+  path = RelPath(file, pdir)
+  if path.startswith(os.pardir + os.sep): path = os.path.abspath(file)
+  return NinjaEscape(path).replace(' ', '$ ').replace(':', '$:')
+
+def NinjaRule(rule):
+  # ninja names only allow letters, digits, _, . and -
+  return SafeName(rule.s_Name)
+
+def QuoteArgs(args):
+  if os.name == 'nt': return subprocess.list2cmdline(args)
+  return ' '.join([shlex.quote(arg) for arg in args])
+
+def NinjaCommand(job, pdir):
+  # returns the command line of job and its dependency file or None
+  cmd = job.s_Cmd
+  args = CommandArgs(cmd)
+  cargs = CompileArgs(args, pdir)
+  if cargs is None: return cmd, None
+  if not cargs or cargs[0] != '--depfile':
+    # ninja only learns the headers from the dependency file
+    i = len(args) - len(cargs)
+    cmd = QuoteArgs(args[:i] + ['--depfile'] + args[i:])
+    cargs = ['--depfile'] + cargs
+  depfile = _compile.Compilation(cargs, pdir).s_DepFile
+  if os.name != 'nt':
+    # like build.py runs them, compile.py records the headers next to ours
+    # and leaves the up to date check to ninja
+    cmd = 'PYBUILD_DEPDB=%s PYBUILD_CHECKED=1 %s' % (QuoteArgs(
+      [RelPath(job.o_Target.s_DepDir, pdir)]), cmd)
+  return cmd, depfile
+
+def NinjaName(target, bucket=None):
+  # the phony of a configuration, like "hello_world-Debug", or of the
+  # Barrier of one of its buckets, like "hello_world-Debug.bucket1"
+  name = target.h_State['ProjectName'] + '-' + target.h_State['ConfigurationName']
+  if bucket is not None: name += '.bucket%d' % bucket
+  return NinjaEscape(name).replace(' ', '$ ').replace(':', '$:')
+
+def NinjaFile(pdir, targets, jobs):
+  out = ["# generated by build.py --emit-ninja, edit the projects instead",
+    "ninja_required_version = 1.3", ""]
+  for name in sorted(set(NinjaRule(job.r_Rule) for job in jobs)):
+    out += ["rule " + name, "  command = $cmd", "  description = $desc", ""]
+  for job in jobs:
+    if job.s_RspFile:
+      # the response files only change with the project, so they are
+      # written now instead of by ninja
+      WriteIfChanged(job.s_RspFile, job.s_RspContent)
+    cmd, depfile = NinjaCommand(job, pdir)
+    implicit = [job.s_RspFile] if job.s_RspFile else []
+    line = "build " + " ".join([NinjaPath(f, pdir) for f in job.a_Outputs])
+    line += ": " + NinjaRule(job.r_Rule)
+    line += "".join([" " + NinjaPath(f, pdir) for f in job.a_Inputs])
+    if implicit:
+      line += " |" + "".join([" " + NinjaPath(f, pdir) for f in implicit])
+    if job.a_After:
+      line += " || " + NinjaName(job.o_Target, job.a_After[0].i_Bucket)
+    out += [line, "  cmd = " + NinjaEscape(cmd), 
+      "  desc = " + NinjaEscape(job.s_Desc or cmd)]
+    if depfile:
+      out += ["  depfile = " + NinjaEscape(depfile), "  deps = gcc"]
+    out.append("")
+  # a phony per Barrier, over the outputs of its jobs and the Barrier
+  # before it. Every Barrier is in the a_After of the next bucket.
+  barriers = {}
+  for job in jobs:
+    for barrier in job.a_After: barriers[barrier] = True
+  for barrier in barriers:
+    outputs = {}
+    for dep in barrier.a_Deps:
+      if isinstance(dep, Barrier):
+        outputs[NinjaName(dep.o_Target, dep.i_Bucket)] = True
+      else:
+        for f in dep.a_Outputs: outputs[NinjaPath(f, pdir)] = True
+    out += ["build " + NinjaName(barrier.o_Target, barrier.i_Bucket) + 
+      ": phony" + "".join([" " + f for f in outputs]), ""]
+  # a phony target per configuration, like "ninja hello_world-Debug"
+  for target in targets:
+    outputs = []
+    for job in jobs:
+      if job.o_Target is target: outputs += job.a_Outputs
+    out.append("build " + NinjaName(target) + ": phony" + 
+      "".join([" " + NinjaPath(f, pdir) for f in outputs]))
+  # rerun the export when a project or rule file changed
+  here = os.path.dirname(os.path.abspath(__file__))
+  sources = [os.path.join(here, 'build.py'), os.path.join(here, 'compile.py')]
+  for target in targets:
+    sources += [target.h_State['ProjectPath']] + target.h_State['RuleFiles']
+  cmd = QuoteArgs([sys.executable, os.path.abspath(sys.argv[0])] + sys.argv[1:])
+  if os.name == 'nt': cmd = 'cmd /c cd /d %s && %s' % (QuoteArgs([os.getcwd()]), cmd)
+  else: cmd = 'cd %s && %s' % (QuoteArgs([os.getcwd()]), cmd)
+  out += ["", "rule pybuild", "  command = " + NinjaEscape(cmd),
+    "  description = Regenerating build.ninja", "  generator = 1", "",
+    "build build.ninja: pybuild" + "".join([" " + NinjaPath(AbsrelPath(f, 
+    os.curdir), pdir) for f in dict.fromkeys(sources)]), ""]
+  return "\n".join(out)
+
+def EmitNinja(targets):
+  graph = BuildGraph()
+  graph.b_All = True
+  for target in targets:
+    target.Select()
+    graph.o_Target = target
+    target.c_Config.Plan(graph)
+  graph.Finish()
+  # commands run in the ProjectDir, so each one gets its own build.ninja
+  dirs = {}
+  for target in targets:
+    dirs.setdefault(target.s_ProjectDir, ([], []))[0].append(target)
+  for job in graph.a_Jobs:
+    dirs[job.o_Target.s_ProjectDir][1].append(job)
+  for pdir, (dtargets, jobs) in dirs.items():
+    file = os.path.join(pdir, 'build.ninja')
+    WriteIfChanged(file, NinjaFile(pdir, dtargets, jobs))
+    print( "------ Wrote", RelPath(file, os.curdir) + ":", len(jobs), 
+      "commands ------" )
+  return 0
+
+
+###############################################################################
+# Watch mode
+
+# Waits for changes of a set of files. On Linux the directories of the
+# files are watched with inotify through ctypes, elsewhere the files are
+# polled.
+class Watcher:
+  i_Mask = 0x4 | 0x8 | 0x40 | 0x80 | 0x100 | 0x200 # attrib, close write,
+                                                   # moves, create, delete
+  def __init__(self):
+    self.a_Files = set()
+    self.h_Stamps = {}  # file -> stamp when polling
+    self.h_Dirs = {}    # directory -> inotify watch
+    self.h_Watches = {} # inotify watch -> directory
+    self.a_Relist = set() # directories files were added to or removed from
+    self.i_Fd = -1
+    if not sys.platform.startswith('linux'): return
+    try:
+      import ctypes, ctypes.util
+      self.l_Libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+      self.i_Fd = self.l_Libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError, ImportError, TypeError):
+      pass
+      
+  def PollStamp(self, file):
+    try:
+      st = os.stat(file)
+      return (st.st_mtime_ns, st.st_size)
+    except OSError:
+      return None
+      
+  def Watch(self, files):
+    self.a_Files = set(files)
+    if self.i_Fd < 0:
+      self.h_Stamps = dict((file, self.PollStamp(file)) for file in files)
+      return
+    for dir in set(os.path.dirname(file) for file in files):
+      if dir in self.h_Dirs: continue
+      wd = self.l_Libc.inotify_add_watch(self.i_Fd, os.fsencode(dir), 
+        self.i_Mask)
+      if wd >= 0:
+        self.h_Dirs[dir] = wd
+        self.h_Watches[wd] = dir
+        
+  def Changes(self, timeout):
+    # returns the watched files changed within timeout seconds, None
+    # waits until one changed
+    changed = set()
+    if self.i_Fd < 0:
+      time.sleep(0.5 if timeout is None else timeout)
+      for file, stamp in self.h_Stamps.items():
+        new = self.PollStamp(file)
+        if new != stamp:
+          self.h_Stamps[file] = new
+          changed.add(file)
+      return changed
+    if not select.select([self.i_Fd], [], [], timeout)[0]: return changed
+    try:
+      data = os.read(self.i_Fd, 1 << 16)
+    except BlockingIOError:
+      return changed
+    i = 0
+    while i + 16 <= len(data):
+      # struct inotify_event { int wd; u32 mask, cookie, len; char name[] }
+      wd, mask, cookie, size = struct.unpack_from('iIII', data, i)
+      name = data[i+16:i+16+size].rstrip(b'\0')
+      i += 16 + size
+      dir = self.h_Watches.get(wd)
+      if dir is None or not name: continue
+      if mask & (0x40 | 0x80 | 0x100 | 0x200): self.a_Relist.add(dir)
+      file = NormFile(os.path.join(dir, os.fsdecode(name)))
+      if file in self.a_Files: changed.add(file)
+    return changed
+    
+  def Wait(self):
+    # blocks until watched files changed and returns them
+    changed = set()
+    while not changed:
+      changed = self.Changes(None)
+    # editors save in several steps, collect them all
+    while True:
+      more = self.Changes(0.1)
+      if not more: return changed
+      changed |= more
+      
+def WatchedFiles(targets):
+  # the sources, recorded headers, project and rule files of the targets
+  files = set()
+  for target in targets:
+    target.Select()
+    outputs = set(Files.Outputs())
+    files.update(file for file in Files if not file in outputs)
+    files.update(NormFile(dep) for dep in RecordedDeps(outputs, target.s_DepDir))
+    files.update(NormFile(file) for file in [ProjectPath] + RuleFiles)
+  return files
+  
+# Builds the targets after every change of their files. The loaded projects
+# and the stat cache are kept, only the changed files and the outputs are
+# stat'd again and the directories inotify saw files being added to or
+# removed from are listed again. A project is loaded again if it or one of
+# its rule files changed, it may name files in any directory, so the stat
+# cache starts over then.
+def WatchTargets(targets, load):
+  global Stats
+  watcher = Watcher()
+  while True:
+    try:
+      BuildTargets(targets)
+    except SystemExit:
+      pass # the error was reported, wait for it to be fixed
+    if Trace:
+      Trace.Save()
+      Trace.Summary()
+    watcher.Watch(WatchedFiles(targets))
+    print( "------ Watching", len(watcher.a_Files), "files for changes ------" )
+    sys.stdout.flush()
+    try:
+      changed = watcher.Wait()
+    except KeyboardInterrupt:
+      return
+    for file in changed:
+      Stats.Invalidate(file)
+    for dir in watcher.a_Relist:
+      Stats.Forget(dir)
+    watcher.a_Relist = set()
+    # outputs are not watched, they may have been deleted or touched
+    for target in targets:
+      target.Select()
+      for file in Files.Outputs():
+        Stats.Invalidate(file)
     
-  # collect Files
-  files = getFirstElementByTagName(f, "Files")
-  if files: CollectFiles(files)
+    reloaded = {}
+    for target in targets:
+      target.Select()
+      project = [NormFile(file) for file in [ProjectPath] + RuleFiles]
+      if changed.intersection(project) and not target.s_Project in reloaded:
+        Stats = StatCache()
+        try:
+          reloaded[target.s_Project] = load(target.s_Project)
+        except (Exception, SystemExit):
+          print( "Project could not be loaded:", target.s_Project, 
+            sys.exc_info()[1], file=sys.stderr )
+    old = targets
+    targets = []
+    for target in old:
+      if not target.s_Project in reloaded:
+        target.Reset()
+        targets.append(target)
+      elif not reloaded[target.s_Project][0] in targets:
+        targets += reloaded[target.s_Project]
+
 
 ###############################################################################
 # Mainapp and testcode
@@ -582,17 +2475,112 @@ SolutionDir = 'C:\\Sources\\NDSE\\'
 # GCC Setting
 #LoadRulefile('../NDSE/XML/vcproj/devkit.rules')
 #LoadRulefile('Config/Rules/devkit.rules')
-LoadProjectfile('TestProject/hello_world.proj')
+s_Project = 'TestProject/hello_world.proj'
 os.environ['PATH'] += os.pathsep + "C:\\NitroSDK\\devkitPro\\devkitARM\\bin"
 os.environ['DEVKIT_ARM'] = 'C:/NitroSDK/devkitPro/devkitARM'
 
 
-# get a configuration
-cname, conf, = Configurations.popitem()
-if len(sys.argv) > 1:
-  if sys.argv[1] == 'clean':
-    conf.Clean()
-    exit(0)
+parser = argparse.ArgumentParser(description="Builds Visual Studio projects")
+parser.add_argument('action', nargs='?', default='build', 
+  choices=['build', 'clean'])
+parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+  help="number of commands to run in parallel (default: cpu count)")
+parser.add_argument('--no-inprocess', action='store_true',
+  help="run compile.py in its own interpreter for every file")
+parser.add_argument('--cache-dir', default=os.environ.get('PYBUILD_CACHE_DIR'),
+  help="directory to cache the outputs of commands in (default: "
+  "$PYBUILD_CACHE_DIR, no cache if unset)")
+parser.add_argument('--cache-size', type=int, 
+  default=int(os.environ.get('PYBUILD_CACHE_SIZE', 5000)),
+  help="size limit of the cache in MB (default: $PYBUILD_CACHE_SIZE or 5000)")
+parser.add_argument('-p', '--project', action='append', dest='projects',
+  help="project to build, can be given more than once (default: %s)" 
+  % s_Project)
+parser.add_argument('-c', '--config', action='append', dest='configs',
+  help="configuration to build, can be given more than once (default: the "
+  "last one of the project)")
+parser.add_argument('--all-configs', action='store_true',
+  help="build all configurations of the projects")
+parser.add_argument('--watch', action='store_true',
+  help="keep running and build again whenever a source, header, project or "
+  "rule file changes")
+parser.add_argument('--trace', metavar='FILE',
+  help="write the timings of the build phases and commands to FILE in Chrome "
+  "trace format and print a summary")
+parser.add_argument('--slowest', type=int, default=10, metavar='N',
+  help="number of slowest commands the --trace summary lists (default: 10)")
+parser.add_argument('-l', '--max-load', type=float, 
+  default=2 * (os.cpu_count() or 1),
+  help="start no new commands while the load average is above this, 0 "
+  "disables the check (default: twice the cpu count)")
+parser.add_argument('--min-free', type=int, metavar='MB',
+  help="memory to leave free when starting commands besides the "
+  "MemoryUsage of their tool (default: 5%% of the memory)")
+parser.add_argument('--workers', default=os.environ.get('PYBUILD_WORKERS'),
+  metavar='HOST:PORT,...',
+  help="worker.py daemons to run the compile jobs on, the requests carry "
+  "$PYBUILD_WORKER_TOKEN (default: $PYBUILD_WORKERS, all jobs run locally "
+  "if unset)")
+parser.add_argument('--emit-ninja', action='store_true',
+  help="write a build.ninja into the directory of each project instead of "
+  "building")
+args = parser.parse_args()
+Pool = JobPool(args.jobs, args.max_load, args.min_free)
+Jobserver = StartJobServer(args.jobs)
+b_InProcess = not args.no_inprocess
+if args.trace:
+  Trace = Tracer(os.path.abspath(args.trace), args.slowest)
+if args.cache_dir:
+  Cache = ArtifactCache(os.path.abspath(args.cache_dir), args.cache_size << 20)
+if args.workers:
+  if not _worker:
+    print("--workers needs worker.py next to build.py", file=sys.stderr)
+    exit(1)
+  try:
+    Workers = WorkerPool([_worker.ParseAddress(address) 
+      for address in args.workers.split(',') if address.strip()],
+      os.environ.get('PYBUILD_WORKER_TOKEN', ''))
+  except ValueError:
+    print(sys.exc_info()[1], file=sys.stderr)
+    exit(1)
+
+# collect the targets, up to date ones are skipped without loading them
+targets = []
+load = lambda project, cnames=None: LoadTargets(project, 
+  cnames or args.configs or [None], args.all_configs)
+for project in args.projects or [s_Project]:
+  cnames = args.configs or [None]
+  if args.action == 'build' and not (args.all_configs or args.watch or 
+    args.emit_ninja):
+    pending = []
+    for cname in cnames:
+      with Span('up to date check ' + project, 'load'):
+        done = ManifestUpToDate(project, cname)
+      if done:
+        print( "------ Build skipped: Project:", 
+          os.path.splitext(os.path.basename(project))[0] + 
+          ", Configuration:", done, "is up-to-date ------")
+      else: pending.append(cname)
+    cnames = pending
+    if not cnames: continue
+  targets += load(project, cnames)
+
+if args.action == 'clean':
+  for target in targets:
+    target.Select()
+    target.c_Config.Clean()
+  exit(0)
 
+if args.emit_ninja:
+  exit(EmitNinja(targets))
 
-conf.Build()
\ No newline at end of file
+if args.watch:
+  WatchTargets(targets, load)
+else:
+  # the trace of a build with all targets skipped holds their checks
+  ret = BuildTargets(targets) if targets else 0
+  if Trace:
+    Trace.Save()
+    Trace.Summary()
+  if ret != 0:
+    exit(ret)
\ No newline at end of file
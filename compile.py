@@ -2,40 +2,213 @@ import os
 import subprocess
 import sys
 import re
+import json
+import hashlib
+import threading
+import time
 
-cmd = []
-cmd_dep = []
-out = ""
-for i in range(1, len(sys.argv)):
-  arg = sys.argv[i]
-  if arg.startswith('-o'):
-    out = arg
-    cmd.append(arg)
-  else:
-    cmd.append(arg)
-    cmd_dep.append(arg)
-out = out.lstrip('-o')
-
-def Outdated():
-  global out, cmd_dep
-  if not os.path.exists(out): #if output does not exist it is outdated
-    return True
-
-  otime = os.path.getmtime(out)
-  cmd_dep += ['-E', '-M', '-MM']
-  deps = subprocess.Popen(cmd_dep, stdout=subprocess.PIPE).communicate()[0]
-  deps = deps.decode()
-  deps = re.compile('(.+?[^\\\])[ \\r\\n]').findall(deps)
-  for dep in deps:
-    if (dep[-1] in ['\n', '\r', ':']):
-      continue
-    d = dep.lstrip()
-    if os.path.exists(d):
+# compile.py [--depfile] compiler args...
+#
+# --depfile lets the compile itself write the dependency file (-MMD -MF)
+# instead of running the preprocessor a second time to find the headers
+#
+# build.py imports this file and runs a Compilation in its own process
+# instead of starting an interpreter for each file, so the module must not
+# do anything on import and all state lives in the Compilation.
+
+###############################################################################
+# Compilation
+
+class Compilation:
+  def __init__(self, args, cwd=None, env=None):
+    # cwd is the directory the compiler runs in, relative paths in args
+    # are relative to it
+    self.s_Cwd = cwd or os.curdir
+    self.h_Env = os.environ if env is None else env
+    self.a_Cmd = []
+    self.a_CmdDep = []
+    self.s_Out = ""
+    self.b_DepFile = False
+    self.a_Spans = []  # (name, start, end) of the steps timed for --trace
+    if args and args[0] == '--depfile':
+      self.b_DepFile = True
+      args = args[1:]
+    for arg in args:
+      if arg.startswith('-o'):
+        self.s_Out = arg
+        self.a_Cmd.append(arg)
+      else:
+        self.a_Cmd.append(arg)
+        self.a_CmdDep.append(arg)
+    self.s_Out = self.s_Out[2:]
+    self.s_DepFile = os.path.splitext(self.s_Out)[0] + '.d'
+    if self.b_DepFile:
+      self.a_Cmd += ['-MMD', '-MF', self.s_DepFile]
+      
+  def Path(self, file):
+    return os.path.join(self.s_Cwd, file)
+
+  #############################################################################
+  # Dependency database
+  #
+  # The headers found by the preprocessor are stored per output file, so an
+  # up to date check only has to stat them. The database lives in the
+  # directory given by PYBUILD_DEPDB (build.py points it into the
+  # IntermediateDirectory) or next to the output file.
+
+  def DepDbFile(self):
+    d = self.h_Env.get('PYBUILD_DEPDB')
+    if not d:
+      d = self.Path(os.path.join(os.path.dirname(self.s_Out), '.deps'))
+    # build.py looks the record up by the same key (see DepRecordFile)
+    out = os.path.normcase(os.path.realpath(self.Path(self.s_Out)))
+    key = hashlib.sha1(out.encode()).hexdigest()
+    return os.path.join(d, key + '.json')
+
+  def LoadDeps(self):
+    # returns the recorded dependencies, None if they are unknown and False
+    # if they were recorded for other compiler flags
+    try:
+      with open(self.DepDbFile()) as f:
+        rec = json.load(f)
+    except (OSError, ValueError):
+      return None
+    if rec.get('cmd') != self.a_CmdDep: return False
+    return rec.get('deps')
+
+  def SaveDeps(self, deps):
+    file = self.DepDbFile()
+    os.makedirs(os.path.dirname(file), exist_ok=True)
+    tmp = file + '.tmp'
+    with open(tmp, 'w') as f:
+      json.dump({'out': os.path.abspath(self.Path(self.s_Out)), 
+        'cmd': self.a_CmdDep, 'deps': deps}, f)
+    os.replace(tmp, file)
+
+  def ParseDeps(self, s):
+    # parses make style dependencies as written by -M and -MF and returns
+    # the full paths of all prerequisites
+    s = s.replace('\\\r\n', ' ').replace('\\\n', ' ')
+    res = []
+    for line in s.splitlines():
+      dep = ""
+      tokens = []
+      i = 0
+      while i < len(line):
+        c = line[i]
+        if c == '\\' and i + 1 < len(line) and line[i+1] in ' #':
+          dep += line[i+1]
+          i += 1
+        elif c in ' \t':
+          tokens.append(dep)
+          dep = ""
+        else: dep += c
+        i += 1
+      tokens.append(dep)
+      tokens = [t for t in tokens if t]
+      # skip the targets
+      for i in range(len(tokens)):
+        if tokens[i].endswith(':'):
+          tokens = tokens[i+1:]
+          break
+      for d in tokens:
+        d = self.Path(d)
+        if os.path.exists(d):
+          res.append(os.path.abspath(d))
+    return res
+
+  def ScanDeps(self):
+    # runs the preprocessor and returns the full paths of all dependencies
+    start = time.perf_counter()
+    deps = subprocess.Popen(self.a_CmdDep + ['-E', '-M', '-MM'], 
+      stdout=subprocess.PIPE, cwd=self.s_Cwd).communicate()[0]
+    deps = self.ParseDeps(deps.decode())
+    self.a_Spans.append(('dependency scan', start, time.perf_counter()))
+    return deps
+
+  def ReadDepFile(self):
+    # returns the dependencies written by the last compile or None
+    depfile = self.Path(self.s_DepFile)
+    if not os.path.exists(depfile): return None
+    with open(depfile) as f:
+      return self.ParseDeps(f.read())
+
+  def Outdated(self):
+    out = self.Path(self.s_Out)
+    if not os.path.exists(out): #if output does not exist it is outdated
+      return True
+
+    otime = os.path.getmtime(out)
+    deps = self.LoadDeps()
+    if deps is False:
+      return True # the flags changed
+    if deps is None and self.b_DepFile:
+      deps = self.ReadDepFile()
+      if deps is not None: self.SaveDeps(deps)
+    if deps is None:
+      deps = self.ScanDeps()
+      self.SaveDeps(deps)
+    for d in deps:
+      if not os.path.exists(d):
+        return True # a header moved, the compile rescans the dependencies
       dtime = os.path.getmtime(d)
       if dtime >= otime:
         return True #outdated!  
-  return False
+    return False
+    
+  #############################################################################
+  # Compile
+
+  # runs the compiler, writes its reformatted output to the text streams
+  # stdout and stderr and returns its exit code
+  def Compile(self, stdout, stderr):
+    print("compiling", file=stdout)
+    stdout.flush()
+    proc = subprocess.Popen(self.a_Cmd, stdout=subprocess.PIPE, 
+      stderr=subprocess.PIPE, cwd=self.s_Cwd)
+    # both pipes are drained at once, so neither can fill up and block
+    # the compiler
+    err = threading.Thread(target=Forward, args=(proc.stderr, stderr))
+    err.start()
+    Forward(proc.stdout, stdout)
+    err.join()
+    proc.wait()
+    if proc.returncode == 0: self.RecordDeps()
+    return proc.returncode
+
+  # like Compile, but the compiler command is run by run(cmd), which returns
+  # (returncode, stdout, stderr) bytes and leaves the output and dependency
+  # files in place, e.g. after running it on a build worker
+  def CompileWith(self, run, stdout, stderr):
+    print("compiling", file=stdout)
+    ret, out, err = run(self.a_Cmd)
+    for data, stream in ((out, stdout), (err, stderr)):
+      for line in data.decode(errors='replace').splitlines(True):
+        stream.write(ReformatDiagnostic(line))
+    if ret == 0: self.RecordDeps()
+    return ret
+
+  def RecordDeps(self):
+    # the headers may have changed with the source, record the new ones
+    deps = None
+    if self.b_DepFile: deps = self.ReadDepFile()
+    if deps is None: deps = self.ScanDeps()
+    self.SaveDeps(deps)
+    
+  def Run(self, stdout, stderr):
+    # PYBUILD_CHECKED is set by build.py, which only runs outdated files
+    if self.h_Env.get('PYBUILD_CHECKED'):
+      return self.Compile(stdout, stderr)
+    start = time.perf_counter()
+    outdated = self.Outdated()
+    self.a_Spans.append(('up to date check', start, time.perf_counter()))
+    if outdated:
+      return self.Compile(stdout, stderr)
+    return 0
+  
   
+###############################################################################
+# Diagnostics
   
 err_match = re.compile('(.*?):(\d+):(.*?):')
 
@@ -64,20 +237,18 @@ def ReformatLine(m):
 def Reformat(s):
   return err_match.sub(ReformatLine, s)
   
-def Compile():
-  print("compiling")
-  proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-  pin, perr = proc.communicate()
-  pin = Reformat(pin.decode())
-  perr = Reformat(perr.decode())
-
-  sys.stdout.write(pin)
-  sys.stderr.write(perr)
- 
-  exit(proc.returncode)
-  
-  
-if Outdated():
-  Compile()
+def ReformatDiagnostic(line):
+  # a diagnostic has at least three colons, skip the regex on the rest
+  if line.count(':') >= 3: return Reformat(line)
+  return line
+
+def Forward(pipe, out):
+  # reformats and writes the lines of pipe as the compiler prints them
+  for line in iter(pipe.readline, b''):
+    out.write(ReformatDiagnostic(line.decode(errors='replace')))
+    out.flush()
+  pipe.close()
 
 
+if __name__ == "__main__":
+  exit(Compilation(sys.argv[1:]).Run(sys.stdout, sys.stderr))
@@ -0,0 +1,259 @@
+import os
+import sys
+import json
+import base64
+import shutil
+import socket
+import socketserver
+import struct
+import subprocess
+import tempfile
+import threading
+import argparse
+import hmac
+
+# worker.py [--host HOST] [--port PORT] [-j JOBS] [--token TOKEN]
+# worker.py --check [HOST:PORT,...]
+#
+# A build worker: build.py --workers host:port,... ships compile jobs to it
+# instead of running them itself. A job carries the resolved compiler
+# command line, the source and the headers it was found to include, with
+# paths relative to the ProjectDir. The worker writes the files into an
+# empty sandbox directory, runs the command there and sends back the exit
+# code, the output of the compiler and the files it wrote.
+#
+# Anyone who can connect can run commands, so a worker only listens on
+# other addresses than localhost with a token, which the requests have to
+# carry (build.py sends $PYBUILD_WORKER_TOKEN).
+#
+# --check sends a small job to the given workers, or to two workers it
+# starts on localhost, and tells if it came back right.
+#
+# build.py imports this file for the protocol, so the module must not do
+# anything on import.
+
+###############################################################################
+# Protocol
+#
+# Every message is a JSON object preceded by its length as a 4 byte big
+# endian number. One connection carries one request and its reply. The
+# request starts with a small message holding the token, so the job is
+# only read once the client is known. While the job waits and runs the
+# worker sends an empty message every i_Heartbeat seconds, so a client
+# can tell a slow job from a worker that hangs.
+#
+# request: {'token': token}, then
+#          {'args': [...], 'files': {path: data}, 'outputs': [path, ...]}
+# reply:   {'ret': code, 'out': data, 'err': data, 'files': {path: data}}
+#          or {'error': message} if the job was refused
+#
+# data is base64, outputs the command did not write are left out of the
+# reply files.
+
+i_Heartbeat = 10
+i_MaxTokenMessage = 4096
+
+def Send(sock, msg):
+  data = json.dumps(msg).encode()
+  sock.sendall(struct.pack('>I', len(data)) + data)
+
+def ReceiveAll(sock, size):
+  data = bytearray()
+  while len(data) < size:
+    chunk = sock.recv(min(size - len(data), 1 << 20))
+    if not chunk: raise ConnectionError("connection closed")
+    data += chunk
+  return bytes(data)
+
+def Receive(sock, limit=None):
+  # returns the next message, skipping heartbeats. Raises ValueError if it
+  # is larger than limit.
+  while True:
+    size = struct.unpack('>I', ReceiveAll(sock, 4))[0]
+    if size: break
+  if limit is not None and size > limit:
+    raise ValueError("message too large")
+  return json.loads(ReceiveAll(sock, size).decode())
+
+def Encode(data):
+  return base64.b64encode(data).decode('ascii')
+
+def Decode(data):
+  return base64.b64decode(data)
+
+# sends a request to the worker at address (host, port) and returns the
+# reply, raises OSError if the worker cannot be reached or does not send
+# anything, not even a heartbeat, for timeout seconds
+def Request(address, token, msg, timeout=None):
+  with socket.create_connection(address, timeout=timeout) as sock:
+    Send(sock, {'token': token})
+    Send(sock, msg)
+    return Receive(sock)
+
+def IsLoopback(host):
+  try:
+    infos = socket.getaddrinfo(host, None)
+  except OSError:
+    return False
+  return all(info[4][0] == '::1' or info[4][0].startswith('127.') 
+    for info in infos)
+
+def ParseAddress(s):
+  # "host:port" or ":port" for localhost
+  host, sep, port = s.strip().rpartition(':')
+  if not sep: raise ValueError("missing port in worker address " + s)
+  return host or 'localhost', int(port)
+
+###############################################################################
+# Sandbox
+
+def SandboxPath(sandbox, path):
+  # the paths of a job must stay inside its sandbox
+  path = os.path.normpath(path)
+  if os.path.isabs(path) or path.split(os.sep)[0] == os.pardir:
+    raise ValueError("path outside of the sandbox: " + path)
+  return os.path.join(sandbox, path)
+
+def RunJob(msg):
+  sandbox = tempfile.mkdtemp(prefix='pybuild-')
+  try:
+    for path, data in msg['files'].items():
+      file = SandboxPath(sandbox, path)
+      os.makedirs(os.path.dirname(file), exist_ok=True)
+      with open(file, 'wb') as f:
+        f.write(Decode(data))
+    for path in msg['outputs']:
+      os.makedirs(os.path.dirname(SandboxPath(sandbox, path)), exist_ok=True)
+    try:
+      proc = subprocess.Popen(msg['args'], stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE, cwd=sandbox)
+      out, err = proc.communicate()
+      ret = proc.returncode
+    except OSError:
+      # like the shell does for a missing program
+      ret, out, err = 127, b"", (str(sys.exc_info()[1]) + "\n").encode()
+    files = {}
+    for path in msg['outputs']:
+      file = SandboxPath(sandbox, path)
+      if os.path.isfile(file):
+        with open(file, 'rb') as f:
+          files[path] = Encode(f.read())
+    return {'ret': ret, 'out': Encode(out), 'err': Encode(err), 'files': files}
+  finally:
+    shutil.rmtree(sandbox, ignore_errors=True)
+
+###############################################################################
+# Server
+
+class Handler(socketserver.BaseRequestHandler):
+  def handle(self):
+    try:
+      auth = Receive(self.request, i_MaxTokenMessage)
+      if not hmac.compare_digest(str(auth.get('token') or ''), 
+        self.server.s_Token):
+        Send(self.request, {'error': "wrong token"})
+        return
+      msg = Receive(self.request)
+    except (OSError, ValueError, AttributeError):
+      return
+    # heartbeats until the reply is sent, the lock keeps them out of it
+    lock = threading.Lock()
+    done = threading.Event()
+    def beat():
+      while not done.wait(i_Heartbeat):
+        with lock:
+          try:
+            self.request.sendall(struct.pack('>I', 0))
+          except OSError:
+            return
+    threading.Thread(target=beat, daemon=True).start()
+    try:
+      with self.server.l_Slots:
+        try:
+          reply = RunJob(msg)
+        except (OSError, ValueError, KeyError):
+          reply = {'ret': -1, 'out': "", 'files': {},
+            'err': Encode((str(sys.exc_info()[1]) + "\n").encode())}
+    finally:
+      done.set()
+    print(' '.join(msg.get('args', [])[:1] + list(msg.get('outputs', [])[:1])),
+      '->', reply['ret'])
+    sys.stdout.flush()
+    with lock:
+      try:
+        Send(self.request, reply)
+      except OSError:
+        pass
+
+class Server(socketserver.ThreadingTCPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+  def __init__(self, address, jobs, token=''):
+    # more connections than jobs wait for a slot, so the client sees a
+    # busy worker as a slow one
+    self.l_Slots = threading.Semaphore(jobs)
+    self.s_Token = token
+    socketserver.ThreadingTCPServer.__init__(self, address, Handler)
+
+###############################################################################
+# Check
+
+def Check(addresses, token):
+  # returns 0 if a job sent to each of addresses came back right
+  data = os.urandom(1000)
+  code = "import sys, shutil; shutil.copy('in/data', 'out/data'); " \
+    "print('out'); sys.stderr.write('err'); sys.exit(3)"
+  failed = 0
+  for address in addresses:
+    try:
+      reply = Request(address, token, {
+        'args': [sys.executable, '-c', code], 
+        'files': {'in/data': Encode(data)}, 'outputs': ['out/data', 'out/none']})
+      ok = reply.get('ret') == 3 and Decode(reply['out']).strip() == b'out' \
+        and Decode(reply['err']) == b'err' and \
+        reply['files'] == {'out/data': Encode(data)}
+      print("%s:%d" % address, 'ok' if ok else 'wrong reply: %s' % 
+        reply.get('error', reply))
+    except (OSError, ValueError, KeyError):
+      ok = False
+      print("%s:%d" % address, 'failed:', sys.exc_info()[1])
+    if not ok: failed += 1
+  return 1 if failed else 0
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Runs the jobs of build.py")
+  parser.add_argument('--host', default='localhost',
+    help="address to listen on (default: localhost)")
+  parser.add_argument('--port', type=int, default=7532,
+    help="port to listen on (default: 7532)")
+  parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+    help="number of jobs to run at once (default: cpu count)")
+  parser.add_argument('--token', 
+    default=os.environ.get('PYBUILD_WORKER_TOKEN', ''),
+    help="secret the requests have to carry, needed to listen on other "
+    "addresses than localhost (default: $PYBUILD_WORKER_TOKEN)")
+  parser.add_argument('--check', nargs='?', const='', metavar='HOST:PORT,...',
+    help="send a test job to the workers, or to two started on localhost")
+  args = parser.parse_args()
+  
+  if args.check is not None:
+    addresses = [ParseAddress(a) for a in args.check.split(',') if a.strip()]
+    if not addresses:
+      for i in range(2):
+        server = Server(('localhost', 0), 1, args.token)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        addresses.append(server.server_address[:2])
+    exit(Check(addresses, args.token))
+  
+  if not args.token and not IsLoopback(args.host):
+    print("worker.py needs a --token to listen on", args.host, file=sys.stderr)
+    exit(1)
+  server = Server((args.host, args.port), args.jobs, args.token)
+  print("worker listening on %s:%d" % server.server_address[:2])
+  sys.stdout.flush()
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass